@@ -73,6 +73,7 @@ class DwfController(dwf.Dwf):
         self._last_ao0 = 0  # will be overwritten by write_analog()
         self._last_ao1 = 0  # will be overwritten by write_analog()
         self._time_stabilized = time.time()  # will be overwritten by write_analog()
+        self.modulation_reference = None  # (start time, frequency, phase) of the sine started by write_sine()
         self.preset_basic_analog()
 
         self.logger.debug('DwfController object created')
@@ -246,6 +247,83 @@ class DwfController(dwf.Dwf):
         self.do.outputSet(pin, output_set)  # Set output type to push-pull
         self.do.dataSet(pin, (level,))
 
+    def write_clock(self, frequency, pin=0, duty=0.5, steps=100):
+        """
+        Outputs a square wave on a digital pin, for example to trigger cameras. Every rising edge is one trigger, so
+        all the cameras wired to the same pin expose at the same time.
+
+        The pin runs from the internal clock of the device, divided so that a period lasts ``steps`` counts, of which
+        ``duty * steps`` are high. The frequency actually generated is returned, as it is rounded by the divider.
+
+        :param frequency: frequency of the pulses, in Hz
+        :type frequency: float
+        :param pin: digital out pin to use (default 0)
+        :type pin: int
+        :param duty: fraction of the period the output is high (default 0.5)
+        :type duty: float
+        :param steps: number of counts in a period, the resolution of the duty cycle (default 100)
+        :type steps: int
+        :return: frequency generated, in Hz
+        :rtype: float
+        """
+        clock = self.do.internalClockInfo()
+        divider = max(1, int(round(clock / (frequency * steps))))
+        high = min(steps - 1, max(1, int(round(duty * steps))))
+        self.do.enableSet(pin, True)
+        self.do.typeSet(pin, 0)  # Set output type to pulse
+        self.do.idleSet(pin, 0)  # Low while stopped
+        self.do.dividerSet(pin, divider)
+        self.do.counterSet(pin, steps - high, high)
+        self.do.configure(True)
+        generated = clock / (divider * steps)
+        self.logger.info(f'Clock of {generated} Hz on digital pin {pin}')
+        return generated
+
+    def stop_clock(self, pin=0):
+        """ Stops the square wave started by write_clock() and leaves the pin low. """
+        self.do.enableSet(pin, False)
+        self.do.configure(True)
+
+    def write_sine(self, frequency, amplitude, offset=0., channel=0, phase=0.):
+        """
+        Outputs a sine wave on an analog out channel, for example to modulate the potential of the sample.
+
+        The host time at which the output starts, the frequency actually generated and the phase are stored in
+        ``modulation_reference``, so that a lock-in can be referenced to the modulation from the time of each frame
+        instead of from the first frame it receives.
+
+        :param frequency: frequency of the sine, in Hz
+        :type frequency: float
+        :param amplitude: amplitude of the sine, in V
+        :type amplitude: float
+        :param offset: DC offset, in V (default 0)
+        :type offset: float
+        :param channel: analog out channel (default 0)
+        :type channel: int
+        :param phase: phase at the start, in radians (default 0)
+        :type phase: float
+        :return: frequency generated, in Hz
+        :rtype: float
+        """
+        self.ao.nodeEnableSet(channel, self.ao.NODE.CARRIER, True)
+        self.ao.nodeFunctionSet(channel, self.ao.NODE.CARRIER, self.ao.FUNC.SINE)
+        self.ao.nodeFrequencySet(channel, self.ao.NODE.CARRIER, frequency)
+        self.ao.nodeAmplitudeSet(channel, self.ao.NODE.CARRIER, amplitude)
+        self.ao.nodeOffsetSet(channel, self.ao.NODE.CARRIER, offset)
+        self.ao.nodePhaseSet(channel, self.ao.NODE.CARRIER, np.degrees(phase))
+        generated = self.ao.nodeFrequencyGet(channel, self.ao.NODE.CARRIER)
+        before = time.time()
+        self.ao.configure(channel, True)
+        after = time.time()
+        self.modulation_reference = ((before + after) / 2, generated, phase)
+        self.logger.info(f'Sine of {generated} Hz and {amplitude} V on analog out {channel}')
+        return generated
+
+    def stop_sine(self, channel=0):
+        """ Stops the sine started by write_sine(). """
+        self.ao.configure(channel, False)
+        self.modulation_reference = None
+
 
 class SimulatedDwfController:
     """
@@ -260,6 +338,7 @@ class SimulatedDwfController:
         # self._analog_simulation_functions = [lambda v: np.exp(v-0.7)/20, lambda v: np.random.normal(1,.5)]
         self._analog_simulation_functions = [lambda v: np.random.normal(1, .5), lambda v: np.exp(v - 0.7) / 20]
         self.basic_analog_return_std = False
+        self.modulation_reference = None
         from collections import defaultdict
 
         class Dummy:
@@ -363,6 +442,25 @@ class SimulatedDwfController:
         self.ai.channelRangeSet(-1, int(range))
         self.basic_analog_return_std = return_std
 
+    def write_clock(self, frequency, pin=0, duty=0.5, steps=100):
+        """ Simulated version of write_clock(). The simulated cameras pace their frames themselves. """
+        self.logger.info(f'Simulated clock of {frequency} Hz on digital pin {pin}')
+        return frequency
+
+    def stop_clock(self, pin=0):
+        """ Simulated version of stop_clock(). """
+        pass
+
+    def write_sine(self, frequency, amplitude, offset=0., channel=0, phase=0.):
+        """ Simulated version of write_sine(). It only records the modulation. """
+        self.modulation_reference = (time.time(), frequency, phase)
+        self.logger.info(f'Simulated sine of {frequency} Hz and {amplitude} V on analog out {channel}')
+        return frequency
+
+    def stop_sine(self, channel=0):
+        """ Simulated version of stop_sine(). """
+        self.modulation_reference = None
+
     def close(self):
         pass
 
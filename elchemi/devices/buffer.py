@@ -1,9 +1,63 @@
+import os
+import re
+import time
+from contextlib import contextmanager
+from logging import getLogger
 from queue import Queue
-from numpy import array, sum, stack
+from numpy import array, sum
 from sys import getsizeof
 import h5py
+import numpy as np
 from elchemi import buffer_folder
-from threading import Condition, Event
+from threading import Condition, Event, Lock
+from multiprocessing import shared_memory
+
+BYTE_UNITS = {
+    'b': 1, 'kb': 1000, 'mb': 1000**2, 'gb': 1000**3, 'tb': 1000**4,
+    'kib': 1024, 'mib': 1024**2, 'gib': 1024**3, 'tib': 1024**4,
+    }
+
+
+def parse_bytes(size):
+    """ Converts a memory size such as ``'2 GiB'``, ``'512MB'`` or ``1e9`` to a number of bytes. Numbers without
+    units are bytes. """
+    if isinstance(size, str):
+        match = re.fullmatch(r'\s*([\d.eE+]+)\s*([a-zA-Z]*)\s*', size)
+        if match is None or match.group(2).lower() not in BYTE_UNITS | {'': 1}:
+            raise ValueError(f'Can not understand the memory size {size}')
+        return int(float(match.group(1)) * BYTE_UNITS.get(match.group(2).lower(), 1))
+    return int(size)
+
+
+def frame_steps(ids):
+    """ Number of frames the camera acquired between consecutive frame IDs, counting the dropped ones.
+
+    GigE cameras number frames with 16 bits, so their IDs wrap around every 65535 frames, and IDs start again when the
+    camera restarts grabbing. A step that does not go forward is therefore counted as a single frame: frames dropped
+    right at a wrap are missed, but the count never goes backwards.
+    """
+    steps = np.diff(np.asarray(ids, dtype=np.int64))
+    steps[steps <= 0] = 1
+    return steps
+
+
+def metadata_frame_rate(metadata, tick_frequency=1e9):
+    """ Frame rate of a sequence of frames, from their rows of :attr:`CircularBuffer.METADATA_DTYPE`, oldest first.
+
+    It uses the camera timestamps and frame IDs if they are known, so dropped frames do not lower the result, and falls
+    back to the time the host received the frames otherwise. Frame IDs that wrap around are unwrapped, see
+    :func:`frame_steps`. Returns NaN if there are not enough frames.
+    """
+    if len(metadata) < 2:
+        return np.nan
+    ids = metadata['frame_id']
+    frames = int(frame_steps(ids).sum()) if np.all(ids >= 0) else len(metadata) - 1
+    timestamps = metadata['timestamp']
+    if np.all(timestamps >= 0) and timestamps[-1] > timestamps[0]:
+        return float(frames * tick_frequency / (timestamps[-1] - timestamps[0]))
+    elapsed = metadata['host_time'][-1] - metadata['host_time'][0]
+    return float(frames / elapsed) if elapsed > 0 else np.nan
+
 
 class Buffer():
     def __init__(self, type, size = 1, dtype = None, name = 'Buffer'):
@@ -46,23 +100,16 @@ class Buffer():
             return array(self.buffer)
 
     def get_size(self):
-        ''' For each type of buffer used, this returns the space on the disk it will take.
-        For queue queues: Calculate the size of each element in buffer and sum. 
-        For list queues: The expression sys.getsizeof(arr) + arr.nbytes calculates the total size for each array in the list.
+        ''' Returns the memory used by the frames in the buffer, in bytes. Arrays count their data, other objects their
+        size as reported by sys.getsizeof.
         '''
-        if self.type == 'Queue':
-            total_s = 0    
-            for arr in self.buffer.queue:
-                if isinstance(arr, array):
-                    s = array.nbytes
-                else:
-                    s = getsizeof(arr)
-                total_s += s
-            return total_s
-        elif self.type == 'List':
-            print(sum(getsizeof(arr) + arr.nbytes for arr in self.buffer))
-            return sum(getsizeof(arr) + arr.nbytes for arr in self.buffer)
-    
+        frames = self.buffer.queue if self.type == 'Queue' else self.buffer
+        return int(np.sum([arr.nbytes if isinstance(arr, np.ndarray) else getsizeof(arr) for arr in frames]))
+
+    @property
+    def nbytes(self):
+        return self.get_size()
+
     def to_array(self):
         pass
 
@@ -85,14 +132,576 @@ class Buffer():
         # !!! to complete with other dtypes
 
 
-    def save(self):
-        ''' Saves buffer into H5 file'''
+    def save(self, filename='data.h5', frame_rate=None):
+        ''' Saves the frames in the buffer into an H5 file, with the layout that AnalyzeModel.open reads. Frames are
+        written one by one into a preallocated dataset, so they are not copied in memory. To record while acquiring,
+        see elchemi.devices.recorder.Recorder.'''
+        num_frames = len(self)
         if self.type == 'Queue':
-            data = []
-            while not self.buffer.empty():
-                data.append(self.buffer.get())
-            arr = stack(data, axis = 0)
+            frames = (self.buffer.get() for _ in range(num_frames))
+        else:
+            frames = iter(self.buffer)
+        if num_frames == 0:
+            return
+        with h5py.File(filename, 'w') as hf:
+            dataset = None
+            for i in range(num_frames):
+                frame = np.asarray(next(frames))
+                if dataset is None:
+                    dataset = hf.create_dataset('movie/frame', shape=(num_frames, *frame.shape), dtype=frame.dtype)
+                dataset[i] = frame
+            hf['movie/configuration/acq_camera/frame_rate'] = np.nan if frame_rate is None else frame_rate
+
+
+
+class CircularBuffer:
+    """ A Circular Buffer stores frames in a preallocated, contiguous block of memory of shape
+    ``(length, *frame_shape)``. Once the buffer is full, the oldest frames are overwritten. Storing a frame is a single
+    copy into the next slot, no memory is allocated while acquiring.
+
+    Frames are identified by their absolute number, counting from the first frame ever stored. Readers get views on
+    the buffer, which means that a frame read may be overwritten later by the writer if the reader holds it for longer
+    than ``length`` frames.
+
+    The state of the buffer lives in a small control block next to the frames: the total number of frames stored and,
+    for every slot, the number of the frame it holds (or -1 while it is being written). With ``shared=True`` both the
+    frames and the control block are allocated in :mod:`multiprocessing.shared_memory`, so another process can
+    :meth:`~attach` to the buffer using its :attr:`~spec` and read frames without copying them. There is only one
+    writer, readers in other processes do not take the lock, and should check with :meth:`~is_intact` that the frames
+    were not overwritten while they were using them.
+
+    Next to each frame, the buffer keeps a row of :attr:`~METADATA_DTYPE` with the camera timestamp, the frame ID, the
+    grab status, the time the host received it and the version of the camera settings it was acquired with. The frame rate and the frames dropped by the camera are derived
+    from it, see :meth:`~frame_rate` and :attr:`~dropped_frames`.
+
+    For acquisitions longer than what fits in memory, ``on_disk=True`` keeps the frames in a preallocated
+    :class:`numpy.memmap` file in :data:`elchemi.buffer_folder`. The API is the same, and the operating system keeps
+    the most recent frames in its page cache, so only readers going far back in time wait for the disk.
+
+    Several consumers can read the same frames without removing them: each gets its own :class:`BufferCursor` with
+    :meth:`~cursor`, which tracks the absolute number of the next frame it has to read.
+    """
+    TOTAL_FRAMES = 0  # Position of the total number of frames in the control block
+    DROPPED_FRAMES = 1  # Position of the number of frames missing in the sequence of frame IDs
+    CONTROL_HEADER = 2  # Number of entries before the sequence numbers of the slots
+    METADATA_DTYPE = np.dtype([
+        ('timestamp', np.int64),  # Camera timestamp, in ticks of the camera clock, -1 if unknown
+        ('frame_id', np.int64),  # Block or frame ID given by the camera, -1 if unknown
+        ('status', np.int32),  # Error code of the grab, 0 if it succeeded
+        ('host_time', np.float64),  # time.time() when the frame was stored
+        ('settings_version', np.int64),  # Version of the camera settings when the frame was acquired, -1 if unknown
+        ])
+
+    def __init__(self, length, frame_shape, dtype, name='Buffer', shared=False, on_disk=False):
+        """ Creates a new circular buffer that can hold ``length`` frames of the given shape and dtype. If shared is
+        True, the memory is allocated in shared memory, if on_disk is True, the frames are stored in a file. In both
+        cases, they are released with :meth:`~close`. To size the buffer by memory instead of frames, see
+        :meth:`~from_budget`.
+        """
+        if shared and on_disk:
+            raise ValueError('A buffer can be either in shared memory or on disk, not both')
+        self.name = name
+        self.logger = getLogger(__name__)
+        self.lock = Lock()
+        self.cursors = {}
+        self._shm = []
+        self._file = None
+        self._owner = True
+        frame_shape = tuple(frame_shape)
+        dtype = np.dtype(dtype)
+        if on_disk:
+            buffer_folder.mkdir(exist_ok=True)
+            safe_name = re.sub(r'\W+', '_', name)
+            self._file = buffer_folder / f'{safe_name}-{os.getpid()}-{id(self)}.dat'
+        if shared:
+            frames_size = max(1, length * int(np.prod(frame_shape)) * dtype.itemsize)
+            self._shm = [shared_memory.SharedMemory(create=True, size=frames_size),
+                         shared_memory.SharedMemory(create=True, size=(self.CONTROL_HEADER + length) * 8),
+                         shared_memory.SharedMemory(create=True, size=length * self.METADATA_DTYPE.itemsize)]
+        self._setup(length, frame_shape, dtype)
+        self._control[:] = 0
+        self._sequence[:] = -1
+
+    @classmethod
+    def from_budget(cls, budget, frame_shape, dtype, **kwargs):
+        """ Creates the longest buffer of frames of the given shape and dtype that fits in a memory budget.
+
+        Parameters
+        ----------
+        budget : int or str
+            Maximum memory used by the frames, in bytes or as a string with units, e.g. ``'2 GiB'``, see
+            :func:`parse_bytes`
+        frame_shape : tuple
+        dtype : numpy.dtype
+        kwargs
+            Passed to the constructor, e.g. ``name``, ``shared`` or ``on_disk``. On disk, the budget is the size of
+            the file.
+        """
+        frame_bytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+        length = parse_bytes(budget) // max(1, frame_bytes)
+        if length < 1:
+            raise ValueError(f'A budget of {budget} can not hold a single frame of {frame_bytes} bytes')
+        return cls(length, frame_shape, dtype, **kwargs)
+
+    def _setup(self, length, frame_shape, dtype):
+        if self._shm:
+            # frombuffer keeps the memory exported while any view exists, so it can't be unmapped under a reader
+            self.buffer = np.frombuffer(self._shm[0].buf, dtype=dtype, count=length * int(np.prod(frame_shape)))
+            self.buffer = self.buffer.reshape((length, *frame_shape))
+            self._control = np.frombuffer(self._shm[1].buf, dtype=np.int64, count=self.CONTROL_HEADER + length)
+            self.metadata = np.frombuffer(self._shm[2].buf, dtype=self.METADATA_DTYPE, count=length)
         else:
-            arr = self.buffer
-        with h5py.File('data.h5', 'w') as hf:
-            hf.create_dataset(str(self.get_size), data=arr)
+            if self._file is not None:
+                self.buffer = np.memmap(self._file, dtype=dtype, mode='w+', shape=(length, *frame_shape))
+            else:
+                self.buffer = np.empty((length, *frame_shape), dtype=dtype)
+            self._control = np.empty((self.CONTROL_HEADER + length,), dtype=np.int64)
+            self.metadata = np.empty((length,), dtype=self.METADATA_DTYPE)
+        self._sequence = self._control[self.CONTROL_HEADER:]  # Absolute number of the frame held by each slot
+
+    @property
+    def shared(self):
+        return bool(self._shm)
+
+    @property
+    def on_disk(self):
+        return self._file is not None
+
+    @property
+    def spec(self):
+        """ Everything another process needs to :meth:`~attach` to a shared buffer. It can be pickled. """
+        if not self.shared:
+            raise BufferError(f'{self.name} is not in shared memory')
+        return {'frames': self._shm[0].name, 'control': self._shm[1].name, 'metadata': self._shm[2].name,
+                'length': self.length,
+                'frame_shape': self.frame_shape, 'dtype': self.dtype.str, 'name': self.name}
+
+    @classmethod
+    def attach(cls, spec):
+        """ Attaches to a buffer created with ``shared=True``, possibly in another process. The attached buffer reads
+        the same memory as the original one; it should not be used to write frames.
+
+        Parameters
+        ----------
+        spec : dict
+            The :attr:`~spec` of the shared buffer
+        """
+        buffer = cls.__new__(cls)
+        buffer.name = spec['name']
+        buffer.logger = getLogger(__name__)
+        buffer.lock = Lock()
+        buffer.cursors = {}
+        buffer._owner = False
+        buffer._file = None
+        buffer._shm = [shared_memory.SharedMemory(name=spec['frames']),
+                       shared_memory.SharedMemory(name=spec['control']),
+                       shared_memory.SharedMemory(name=spec['metadata'])]
+        buffer._setup(spec['length'], tuple(spec['frame_shape']), np.dtype(spec['dtype']))
+        return buffer
+
+    @property
+    def length(self):
+        return self.buffer.shape[0]
+
+    @property
+    def frame_shape(self):
+        return self.buffer.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.buffer.dtype
+
+    @property
+    def frame_nbytes(self):
+        return self.buffer[0].nbytes
+
+    @property
+    def nbytes(self):
+        """ Memory allocated for the frames, in bytes. """
+        return self.buffer.nbytes
+
+    @property
+    def used_nbytes(self):
+        """ Memory taken by the frames stored so far, in bytes. It only differs from ``nbytes`` until the buffer is
+        full for the first time. """
+        return len(self) * self.frame_nbytes
+
+    @property
+    def evicted_frames(self):
+        """ Number of frames that were overwritten by newer ones. """
+        return max(0, self.total_frames - self.length)
+
+    @property
+    def high_water_mark(self):
+        """ Largest number of frames any consumer had waiting when it read the buffer. If it gets close to
+        ``length``, consumers are about to be lapped and the buffer should be longer. """
+        return max((cursor.high_water_mark for cursor in list(self.cursors.values())), default=0)
+
+    def memory_report(self):
+        """ Summary of the memory use and of the consumers of the buffer. """
+        return {
+            'length': self.length,
+            'nbytes': self.nbytes,
+            'used_nbytes': self.used_nbytes,
+            'total_frames': self.total_frames,
+            'evicted_frames': self.evicted_frames,
+            'high_water_mark': self.high_water_mark,
+            'high_water_nbytes': self.high_water_mark * self.frame_nbytes,
+            'lost_frames': {name: cursor.lost_frames for name, cursor in list(self.cursors.items())},
+            }
+
+    @property
+    def total_frames(self):
+        """ Number of frames that have ever been stored in the buffer. """
+        return int(self._control[self.TOTAL_FRAMES])
+
+    @property
+    def write_index(self):
+        """ Slot where the next frame will be stored. """
+        return self.total_frames % self.length
+
+    def put(self, frame, timestamp=-1, frame_id=-1, status=0, settings_version=-1):
+        """ Copies a single frame into the next slot of the buffer, overwriting the oldest frame if it is full.
+
+        Parameters
+        ----------
+        frame : numpy.array
+        timestamp : int
+            Timestamp of the frame given by the camera, in ticks of its clock
+        frame_id : int
+            ID of the frame given by the camera, consecutive frames have consecutive IDs
+        status : int
+            Error code of the grab, 0 if it succeeded
+        settings_version : int
+            Version of the settings of the camera, frames with the same version were acquired with the same settings
+        """
+        with self.writing(timestamp, frame_id, status, settings_version) as slot:
+            np.copyto(slot, frame, casting='unsafe')
+
+    @contextmanager
+    def writing(self, timestamp=-1, frame_id=-1, status=0, settings_version=-1):
+        """ Gives the next slot of the buffer to write a frame directly in it, for example from the memory of the camera
+        driver, without an intermediate copy. The frame is only stored once the block exits without an exception. See
+        :meth:`~put` for the parameters.
+
+        Example
+        -------
+        >>> with buffer.writing(frame_id=grab_id) as slot:
+        ...     np.copyto(slot, raw_frame.T)
+        """
+        host_time = time.time()
+        with self.lock:
+            total = self.total_frames
+            slot = total % self.length
+            # The slot is marked as invalid while it is written, so that readers in other processes can tell
+            self._sequence[slot] = -1
+            yield self.buffer[slot]
+            if frame_id >= 0 and total > 0:
+                previous_id = self.metadata[(total - 1) % self.length]['frame_id']
+                if previous_id >= 0:
+                    self._control[self.DROPPED_FRAMES] += frame_steps((previous_id, frame_id))[0] - 1
+            self.metadata[slot] = (timestamp, frame_id, status, host_time, settings_version)
+            self._sequence[slot] = total
+            self._control[self.TOTAL_FRAMES] = total + 1
+
+    def append(self, frames):
+        """ Appends a stack of frames, the first dimension being time. """
+        for frame in frames:
+            self.put(frame)
+
+    def _views(self, first, N):
+        """ Views on N frames starting at the absolute frame number first. The lock must be held. """
+        start = first % self.length
+        if start + N <= self.length:
+            return self.buffer[start:start + N],
+        return self.buffer[start:], self.buffer[:start + N - self.length]
+
+    def get_views(self, N):
+        """ Returns the last N frames, oldest first, without copying them. If they are contiguous in memory, there is
+        a single view. If they wrap around the end of the buffer, there are two views that must be read one after the
+        other.
+        """
+        with self.lock:
+            total = self.total_frames
+            if N > min(total, self.length):
+                raise ValueError(f"There are not enough frames in the buffer to get {N}")
+            return self._views(total - N, N)
+
+    def get_last_N(self, N):
+        """ Returns the last N frames, oldest first, as a single array. It is a view if the frames are contiguous and a
+        copy otherwise.
+        """
+        return self._join(self.get_views(N))
+
+    def get_values(self, first, last):
+        """ Returns the frames with absolute numbers between first (included) and last (excluded), see
+        :meth:`~get_last_N`.
+        """
+        with self.lock:
+            total = self.total_frames
+            if last > total:
+                raise BufferError(f"Frame {last - 1} was not acquired yet")
+            if first < total - self.length:
+                raise BufferError(f"Data is not available anymore {first}, {last}")
+            views = self._views(first, last - first)
+        return self._join(views)
+
+    def get_frames(self, numbers):
+        """ Returns a copy of the frames with the given absolute numbers, which do not need to be consecutive, e.g. to
+        pick the frames of one camera that match the frames of another one.
+        """
+        numbers = np.asarray(numbers, dtype=np.int64)
+        with self.lock:
+            total = self.total_frames
+            if len(numbers) and (numbers.max() >= total or numbers.min() < total - self.length):
+                raise BufferError(f"Frames {numbers.min()} to {numbers.max()} are not all available")
+            return self.buffer[numbers % self.length]
+
+    def is_intact(self, first, last):
+        """ Checks that the frames between first (included) and last (excluded) are still in the buffer and were
+        not (even partially) overwritten. Readers that do not share the lock with the writer, such as other processes,
+        should call it after they are done with the frames, and discard their results if it returns False.
+        """
+        if last - first > self.length:
+            return False
+        slots = np.arange(first, last) % self.length
+        return bool(np.all(self._sequence[slots] == np.arange(first, last)))
+
+    def cursor(self, name, from_start=False):
+        """ Returns the read cursor of the consumer with the given name, creating it if needed.
+
+        Parameters
+        ----------
+        name : str
+            Identifies the consumer, for example ``'display'``, ``'fft'`` or ``'recorder'``
+        from_start : bool
+            If True, a new cursor starts at the oldest frame available, otherwise it only sees frames stored after
+            its creation.
+        """
+        with self.lock:
+            if name not in self.cursors:
+                total = self.total_frames
+                position = max(0, total - self.length) if from_start else total
+                self.cursors[name] = BufferCursor(self, name, position)
+            return self.cursors[name]
+
+    def remove_cursor(self, name):
+        with self.lock:
+            self.cursors.pop(name, None)
+
+    def _read_cursor(self, cursor, N, advance, last):
+        """ Views for a cursor, see :meth:`BufferCursor.read`. """
+        with self.lock:
+            total = self.total_frames
+            oldest = max(0, total - self.length)
+            if not last:
+                cursor.high_water_mark = max(cursor.high_water_mark, total - cursor.position)
+            if cursor.position < oldest and not last:
+                lost = oldest - cursor.position
+                cursor.lost_frames += lost
+                cursor.laps += 1
+                cursor.position = oldest
+                self.logger.warning(f'{self.name}: consumer {cursor.name} was lapped, {lost} frames lost')
+            if last:
+                N = min(N, total - oldest)
+                first = total - N
+                cursor.position = total
+            else:
+                N = total - cursor.position if N is None else N
+                if N == 0 or cursor.position + N > total:
+                    return None
+                first = cursor.position
+                cursor.position += N if advance is None else advance
+            return first, self._views(first, N)
+
+    def get_metadata(self, first, last):
+        """ Returns a copy of the metadata of the frames between first (included) and last (excluded). """
+        with self.lock:
+            total = self.total_frames
+            if last > total or first < total - self.length:
+                raise BufferError(f"Metadata of frames {first} to {last} is not available")
+            start = first % self.length
+            return np.concatenate([self.metadata[start:start + last - first],
+                                   self.metadata[:max(0, start + last - first - self.length)]])
+
+    def get_last_metadata(self, N):
+        """ Returns a copy of the metadata of the last N frames, oldest first. """
+        total = self.total_frames
+        return self.get_metadata(total - min(N, len(self)), total)
+
+    @property
+    def dropped_frames(self):
+        """ Number of frames that the camera acquired but never reached the buffer, from the gaps in frame IDs. """
+        return int(self._control[self.DROPPED_FRAMES])
+
+    def frame_rate(self, N=None, tick_frequency=1e9):
+        """ Frame rate of the camera over the last N frames stored (all the frames in the buffer by default), see
+        :func:`metadata_frame_rate`.
+
+        Parameters
+        ----------
+        N : int or None
+            Number of frames to use, at least 2
+        tick_frequency : float
+            Frequency of the camera clock used in the timestamps, in Hz
+
+        Returns
+        -------
+        float
+            Frames per second, NaN if there are not enough frames
+        """
+        return metadata_frame_rate(self.get_last_metadata(len(self) if N is None else N), tick_frequency)
+
+    @staticmethod
+    def _join(views):
+        if len(views) == 1:
+            return views[0]
+        return np.concatenate(views, axis=0)
+
+    @property
+    def latest(self):
+        """ View on the last frame stored, or None if the buffer is empty. """
+        total = self.total_frames
+        if total == 0:
+            return None
+        return self.buffer[(total - 1) % self.length]
+
+    def copy_latest(self):
+        """ Copy of the last frame stored, or None if the buffer is empty. The writer holds the lock while it stores a
+        frame, so the copy is never mixed with the next one. """
+        with self.lock:
+            latest = self.latest
+            return None if latest is None else latest.copy()
+
+    def clear(self):
+        with self.lock:
+            self._sequence[:] = -1
+            self._control[self.TOTAL_FRAMES] = 0
+            self._control[self.DROPPED_FRAMES] = 0
+            for cursor in self.cursors.values():
+                cursor.position = 0
+
+    def close(self):
+        """ Releases the shared memory or the file on disk. The process that created the buffer also destroys it,
+        attached processes only detach from it. It does nothing if the buffer is in memory.
+        """
+        if self._file is not None:
+            filename, self._file = self._file, None
+            self.buffer = None
+            try:
+                filename.unlink()
+            except OSError:
+                # On Windows a mapped file can't be removed while views on it are alive
+                self.logger.warning(f'Could not remove {filename}, remove it once the acquisition is over')
+        shms, self._shm = self._shm, []
+        if shms:
+            # Our own arrays export the shared memory, they must be gone before closing it
+            self.buffer = self._control = self._sequence = self.metadata = None
+        for shm in shms:
+            if self._owner:
+                shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # Views on the frames are still alive, they keep the mapping open until they are garbage collected.
+                # Forget it here, otherwise SharedMemory tries to close it again when deleted.
+                shm._mmap = None
+
+    def __len__(self):
+        """ Number of frames available in the buffer. """
+        return min(self.total_frames, self.length)
+
+
+class BufferCursor:
+    """ Read position of one consumer of a :class:`CircularBuffer`, created with :meth:`CircularBuffer.cursor`.
+    Reading does not remove frames from the buffer, so consumers do not interfere with each other.
+
+    If the writer stores more than ``length`` frames between two reads, the frames the consumer did not read are lost:
+    the cursor is moved to the oldest frame available, and the loss is counted in ``lost_frames`` and ``laps``.
+    """
+    def __init__(self, buffer, name, position):
+        self.buffer = buffer
+        self.name = name
+        self.position = position  # Absolute number of the next frame to read
+        self.lost_frames = 0
+        self.laps = 0
+        self.high_water_mark = 0  # Largest number of frames waiting to be read
+
+    @property
+    def available(self):
+        """ Number of frames stored since the last read, it can be larger than the buffer if it was lapped. """
+        return self.buffer.total_frames - self.position
+
+    @property
+    def lapped(self):
+        """ Whether frames were overwritten before this consumer read them. """
+        return self.position < self.buffer.total_frames - self.buffer.length
+
+    def read_views(self, N=None, advance=None):
+        """ Reads N frames starting at the cursor, without copying them, see :meth:`CircularBuffer.get_views`.
+
+        Parameters
+        ----------
+        N : int or None
+            Number of frames to read, by default all the frames available
+        advance : int or None
+            How much the cursor moves forward, by default N. A smaller value gives overlapping windows, for example
+            ``read(window, advance=hop)``.
+
+        Returns
+        -------
+        tuple or None
+            ``(first, views)``, the absolute number of the first frame and the views on the frames. None if fewer
+            than N frames are available yet, in which case the cursor does not move.
+        """
+        return self.buffer._read_cursor(self, N, advance, last=False)
+
+    def read(self, N=None, advance=None):
+        """ Like :meth:`~read_views`, but returns the frames as a single array, which is only a copy if they wrap
+        around the end of the buffer. Returns None if there are not enough frames.
+        """
+        result = self.read_views(N, advance)
+        if result is None:
+            return None
+        return self.buffer._join(result[1])
+
+    def read_last(self, N):
+        """ Returns the most recent N frames, or fewer if the buffer does not hold that many yet, and moves the cursor
+        after them. Frames older than those are skipped without being counted as lost.
+        """
+        return self.buffer._join(self.buffer._read_cursor(self, N, None, last=True)[1])
+
+    def copy_last(self, N):
+        """ Like :meth:`~read_last`, but returns a copy that the writer can not change anymore. The writer keeps going
+        while the frames are copied, so the oldest ones may be overwritten before they are copied: they are checked
+        afterwards with the sequence numbers of their slots, and dropped from the result. The result can therefore be
+        shorter than N, and it is empty only if the writer lapped the whole copy.
+        """
+        first, views = self.buffer._read_cursor(self, N, None, last=True)
+        return self._copy(first, views)[1]
+
+    def copy(self, N=None):
+        """ Like :meth:`~read`, but returns copies of the frames and of their metadata that the writer can not change
+        anymore. Frames overwritten while they are copied are dropped, like in :meth:`~copy_last`.
+
+        Returns
+        -------
+        tuple or None
+            ``(first, frames, metadata)``, the absolute number of the first frame that was kept, the frames and their
+            rows of :attr:`CircularBuffer.METADATA_DTYPE`. None if fewer than N frames are available.
+        """
+        result = self.read_views(N)
+        if result is None:
+            return None
+        return self._copy(*result)
+
+    def _copy(self, first, views):
+        frames = np.concatenate(views, axis=0)
+        numbers = np.arange(first, first + len(frames))
+        metadata = self.buffer.metadata[numbers % self.buffer.length]
+        overwritten = np.flatnonzero(self.buffer._sequence[numbers % self.buffer.length] != numbers)
+        if len(overwritten):
+            # Slots are overwritten in order, every frame before an overwritten one is lost as well
+            kept = overwritten[-1] + 1
+            return first + kept, frames[kept:], metadata[kept:]
+        return first, frames, metadata
@@ -0,0 +1,213 @@
+"""
+Camera array
+============
+
+Acquires with several Basler cameras at once, for example to image two wavelengths or two fields of view at the full
+frame rate of every camera instead of alternating between them.
+
+All the cameras are hardware triggered by the same digital output of the DAQ, so they expose at the same time. Each
+camera keeps its own grab thread and its own :class:`~elchemi.devices.buffer.CircularBuffer`, exactly as when it is
+used alone. The frames are stored with the number of the trigger that started them, which is what
+:meth:`CameraArray.aligned_frames` uses to match the frames of the different cameras, even if one of them missed a
+trigger. Cameras that can count their triggers send the count with every frame (see
+:meth:`~elchemi.devices.camera.basler.BaslerCamera._trigger_count`). The others number them from their timestamps
+(see :meth:`~elchemi.devices.camera.basler.BaslerCamera._trigger_index`). The clocks of all the cameras are latched
+to the clock of the host before the triggers start, and a :class:`TriggerReference` shared by all the cameras numbers
+their first frames on a common time base, so a camera that missed the first trigger is not off by one, and cameras
+of both kinds can be mixed in an array.
+"""
+import time
+from logging import getLogger
+from threading import Lock
+
+import numpy as np
+
+
+class TriggerReference:
+    """ Numbers the first frame of every camera of an array from its time on the clock of the host. The first frame
+    stored by any camera fixes the phase of the triggers. Its number is the count of triggers before it if the camera
+    counts them, or else the number of trigger periods since ``start``, the moment the cameras were armed.
+    """
+    ambiguous_phase = 0.25  # Fraction of a period between a frame and the expected trigger that makes it ambiguous
+
+    def __init__(self, start):
+        self.logger = getLogger(__name__)
+        self.start = start
+        self.time = None  # Host time of the first frame of any camera
+        self.first_index = None
+        self._lock = Lock()
+
+    def index(self, host_time, frequency, count=None):
+        """ Number of the trigger of a frame acquired at ``host_time`` by triggers at ``frequency`` Hz. ``count`` is
+        the number of triggers before the frame, for cameras that count them, it is only used for the very first
+        frame of the array.
+        """
+        with self._lock:
+            if self.time is None:
+                self.time = host_time
+                self.first_index = max(0, int((host_time - self.start) * frequency)) if count is None else count
+                return self.first_index
+        periods = (host_time - self.time) * frequency
+        index = self.first_index + int(round(periods))
+        if abs(periods - round(periods)) > self.ambiguous_phase:
+            self.logger.warning(f'A frame arrived {abs(periods - round(periods)):.2f} periods away from the triggers '
+                                f'of the other cameras, it may be misaligned. The clocks of the cameras could not be '
+                                f'latched close enough for {frequency} Hz.')
+        return index
+
+
+class CameraArray:
+    safety_margin = 0.25  # Fraction of a full buffer, the oldest frames, that aligned_frames skips while running
+
+    def __init__(self, cameras, daq=None, trigger_source='Line1', trigger_pin=0):
+        """ Groups cameras that are triggered together.
+
+        Parameters
+        ----------
+        cameras : list of BaslerCamera
+            Cameras of the array, not initialized yet. Cameras of the same model are told apart by their serial
+            number, given as their ``camera`` name.
+        daq : DwfController or None
+            Device that generates the trigger pulses, see
+            :meth:`~elchemi.devices.DAQ.waveforms.DwfController.write_clock`. Without it, the pulses must come from
+            elsewhere, and :meth:`~start` only arms the cameras.
+        trigger_source : str
+            Input line of the cameras wired to the trigger
+        trigger_pin : int
+            Digital output pin of the DAQ wired to the cameras
+        """
+        if len(cameras) == 0:
+            raise ValueError('A camera array needs at least one camera')
+        self.logger = getLogger(__name__)
+        self.cameras = list(cameras)
+        self.daq = daq
+        self.trigger_source = trigger_source
+        self.trigger_pin = trigger_pin
+        self.frame_rate = None
+        self.running = False
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __iter__(self):
+        return iter(self.cameras)
+
+    def __getitem__(self, item):
+        return self.cameras[item]
+
+    @property
+    def buffers(self):
+        return [camera.external_buffer for camera in self.cameras]
+
+    def initialize(self):
+        """ Opens all the cameras and sets them to start every frame on the trigger. """
+        for camera in self.cameras:
+            camera.initialize()
+            camera.set_trigger(self.trigger_source)
+            camera.set_acquisition_mode(camera.MODE_CONTINUOUS)
+
+    def start(self, frame_rate):
+        """ Starts the grab thread of every camera and only then the trigger pulses, so that the first trigger starts
+        the first frame of all the cameras. Before that, the clocks of the cameras are latched to the clock of the
+        host, to number the triggers of all the cameras alike.
+
+        Parameters
+        ----------
+        frame_rate : float
+            Frequency of the triggers, in Hz
+        """
+        if self.running:
+            self.logger.warning('The camera array is already running')
+            return
+        if self.daq is not None:
+            self.daq.stop_clock(self.trigger_pin)
+        # Without a DAQ the triggers may be running already, so the reference is shared before any camera grabs
+        reference = TriggerReference(time.time())
+        for camera in self.cameras:
+            camera.trigger_frequency = frame_rate
+            camera.trigger_reference = reference
+            camera.latch_clock()
+            camera.start_continuous_reads()
+        if self.daq is not None:
+            frame_rate = self.daq.write_clock(frame_rate, self.trigger_pin)
+            for camera in self.cameras:
+                camera.trigger_frequency = frame_rate
+        self.frame_rate = frame_rate
+        self.running = True
+        self.logger.info(f'Camera array of {len(self)} cameras running at {frame_rate} Hz')
+
+    def stop(self):
+        """ Stops the trigger pulses and then the grab threads, so that every camera got the last trigger. """
+        if not self.running:
+            return
+        if self.daq is not None:
+            self.daq.stop_clock(self.trigger_pin)
+            # Leaves time for the frames of the last trigger to be read out
+            exposure = max(camera.settings.get('exposure', 0) for camera in self.cameras) / 1e6
+            time.sleep(exposure + 1 / self.frame_rate)
+        for camera in self.cameras:
+            camera.stop_continuous_reads()
+        self.running = False
+
+    def aligned_frames(self, N=None):
+        """ Returns the last N frames that every camera acquired, matched by trigger number. Triggers that any camera
+        missed, or whose frames were already overwritten in any buffer, are left out.
+
+        While the cameras run, the oldest frames of a full buffer are the next ones to be overwritten, so the oldest
+        ``safety_margin`` fraction of each full buffer is not used. If frames are overwritten anyway while they are
+        copied, the margin is doubled and the frames are read again.
+
+        Parameters
+        ----------
+        N : int or None
+            Maximum number of triggers to return, all the ones available if None
+
+        Returns
+        -------
+        triggers : numpy.array
+            Numbers of the triggers, in increasing order
+        frames : list of numpy.array
+            For every camera, a copy of its frames for those triggers, with shape ``(len(triggers), *frame_shape)``
+        """
+        if any(buffer is None or len(buffer) == 0 for buffer in self.buffers):
+            return np.empty(0, dtype=np.int64), [np.empty((0,)) for _ in self.cameras]
+        margin = self.safety_margin
+        for attempt in range(3):
+            try:
+                return self._aligned_frames(N, margin)
+            except BufferError:
+                # The oldest frames were overwritten while reading, the next attempt stays further from them
+                self.logger.debug('Frames overwritten while aligning them, trying again')
+                margin = min(0.75, 2 * margin)
+        raise BufferError('The cameras overwrite their frames faster than they can be aligned')
+
+    def _aligned_frames(self, N, margin):
+        numbers, ids = [], []
+        for buffer in self.buffers:
+            total = buffer.total_frames
+            first = total - len(buffer)
+            if self.running and total >= buffer.length:
+                first += int(margin * buffer.length)
+            numbers.append(np.arange(first, total))
+            ids.append(buffer.get_metadata(first, total)['frame_id'])
+
+        triggers = ids[0][ids[0] >= 0]
+        for camera_ids in ids[1:]:
+            triggers = np.intersect1d(triggers, camera_ids)
+        if N is not None:
+            triggers = triggers[-N:]
+
+        frames = []
+        for buffer, camera_numbers, camera_ids in zip(self.buffers, numbers, ids):
+            order = np.argsort(camera_ids, kind='stable')
+            selected = camera_numbers[order[np.searchsorted(camera_ids, triggers, sorter=order)]]
+            frames.append(buffer.get_frames(selected))
+        return triggers, frames
+
+    def finalize(self):
+        self.stop()
+        for camera in self.cameras:
+            camera.finalize()
+
+    def __str__(self):
+        return f"Camera array ({', '.join(str(camera) for camera in self.cameras)})"
@@ -8,7 +8,8 @@ from PIL import Image
 
 sys.path.append('/Users/fg/LPL/Code/Elchemi_1/elchemi')
 from elchemi.devices.camera.exceptions import CameraException, CameraNotFound, WrongCameraState
-from elchemi.devices.buffer import Buffer
+from elchemi.devices.buffer import CircularBuffer
+from elchemi.devices.ingest import ColorToMono, Ingest, Unpacker, frame_nbytes, pixel_dtype
 
 class BaslerCamera:
     MODE_CONTINUOUS = 1
@@ -22,7 +23,10 @@ class BaslerCamera:
 
     _acquisition_mode = MODE_SINGLE_SHOT
 
-    def __init__(self, camera: str, external_buffer_size, initial_config: dict={},):
+    def __init__(self, camera: str, external_buffer_size, initial_config: dict={}, shared_buffer=False,
+                 buffer_on_disk=False):
+        """ ``external_buffer_size`` is the number of frames kept in the external buffer, or its memory budget as a
+        string, for example ``'2 GiB'``. """
         self.logger = getLogger(__name__)
         self.config = initial_config
         self.camera = camera
@@ -35,13 +39,32 @@ class BaslerCamera:
         self.initialized = False
         self.finalized = False
         self._buffer_size = None
-        self.external_buffer = Buffer('Queue', size = external_buffer_size)
+        self.external_buffer_size = external_buffer_size
+        self.external_buffer = None  # Allocated once the frame shape and dtype are known, see allocate_buffer
+        self.shared_buffer = shared_buffer  # Allocate the external buffer in shared memory, for analysis processes
+        self.buffer_on_disk = buffer_on_disk  # Keep the external buffer in a file, for histories larger than memory
+        self.timestamp_frequency = 1e9  # Ticks per second of the camera clock, used in the frame timestamps
+        self.driver_buffer_budget = 256 * 1024**2  # Bytes of memory for the buffers of the driver in continuous mode
+        self.ingest = Ingest()  # Converts the frames to mono, and optionally reduces them, before they are stored
+        self.unpacker = Unpacker()  # Unpacks the frames of packed pixel formats such as Mono12p
         self.current_dtype = None
         self._driver = None
         self.width = 0
         self.height = 0
         self.pixel_format = None
         self.thread_reading = None
+        self.grab_timeout = 1000  # ms, the grab loop checks this often whether it has to stop
+        self.settings = {}  # Snapshot of the settings of the camera, see refresh_settings
+        self.settings_version = 0
+        self.auto_check_interval = 0.5  # s, how often settings under automatic control are read, see follow_auto
+        self._last_auto_check = 0
+        self.trigger_source = None  # Input line of the hardware trigger, None for free run, see set_trigger
+        self.trigger_frequency = None  # Hz, if known frame IDs count the hardware triggers, see _trigger_index
+        self.trigger_counter = False  # Whether the frames carry the count of hardware triggers, see set_trigger
+        self.trigger_reference = None  # Shared by the cameras of an array to number their triggers alike
+        self.clock_reference = None  # (host time, camera timestamp) read at the same moment, see latch_clock
+        self._last_trigger = None
+        self._counter_offset = None  # Added to the trigger counter to follow trigger_reference, see _trigger_count
 
     def initialize(self):
         """ Initializes the communication with the camera. Get's the maximum and minimum width. It also forces
@@ -57,33 +80,91 @@ class BaslerCamera:
         if len(devices) == 0:
             raise CameraNotFound('No camera found')
 
+        # The camera is given by (part of) its name or by its serial number, which tells apart cameras of the same
+        # model, for example in a CameraArray
         for device in devices:
-            if self.camera in device.GetFriendlyName():
+            if self.camera in device.GetFriendlyName() or self.camera == device.GetSerialNumber():
                 self._driver = pylon.InstantCamera()
                 self._driver.Attach(tl_factory.CreateDevice(device))
                 self._driver.Open()
                 self.friendly_name = device.GetFriendlyName()
+                break
 
         if not self._driver:
             msg = f'Basler {self.camera} not found. Please check if the camera is connected'
             self.logger.error(msg)
             raise CameraNotFound(msg)
+        self._load_settings()
 
+    def _load_settings(self):
+        """ Reads the settings of a camera that was just opened. """
         self.logger.info(f'Loaded camera {self._driver.GetDeviceInfo().GetModelName()}')
         self.width = self.get_width()
         self.height = self.get_height()
+        try:
+            self.timestamp_frequency = self._driver.GevTimestampTickFrequency.GetValue()
+        except pylon.LogicalErrorException:  # USB cameras count nanoseconds
+            self.timestamp_frequency = 1e9
         self.pixel_format = self.get_pixelformat()
         try:
             self.max_buffer_size = self._driver.MaxBufferSize.GetValue()
         except pylon.LogicalErrorException:         # Traps Missing Node exception in case the MaxBufferSize is not available in the given camera model 
             self.max_buffer_size = None
-            self.logger.warning("MaxBufferSize attribute not found. Maximum buffer size is not directly accessible.")
+            self.logger.warning("MaxBufferSize attribute not found. The size of a single buffer can not be checked.")
         
         nodemap = self._driver.GetNodeMap()
         pixel_format_node = nodemap.GetNode('PixelFormat')
         if pixel_format_node is not None:
             self.supported_pixel_formats = pixel_format_node.GetSymbolics()
-    
+        self.refresh_settings()
+
+    def refresh_settings(self):
+        """ Reads the settings of the camera into ``settings``, a snapshot that the grab loop uses instead of asking
+        the driver. It is called by every setter and when grabbing starts, which is when the camera recalculates its
+        resulting frame rate. Each refresh increases ``settings_version``, which is stored with every frame, so the
+        analysis can tell which frames were acquired with the same settings.
+
+        The snapshot is replaced as a whole, so readers always see consistent values. Exposure and gain under
+        automatic control change without any setter being called, :meth:`~follow_auto` keeps them up to date.
+        """
+        offset_x, offset_y = self._driver.OffsetX.Value, self._driver.OffsetY.Value
+        settings = {
+            'exposure': self.get_exposure(),
+            'gain': self.get_gain(),
+            'exposure_auto': self.get_autoexposure(),
+            'gain_auto': self.get_autogain(),
+            'width': self.get_width(),
+            'height': self.get_height(),
+            'offset': (offset_x, offset_y),
+            'pixel_format': self.get_pixelformat(),
+            'dtype': self.current_dtype,
+            'frame_rate': self.get_frame_rate(),
+            'output_queue_size': self._driver.OutputQueueSize.Value,
+            'acquisition_mode': self._acquisition_mode,
+            'trigger_source': self.trigger_source,
+            }
+        self.settings_version += 1
+        self.settings = settings
+        self.logger.debug(f'{self} settings version {self.settings_version}: {settings}')
+        return settings
+
+    def follow_auto(self):
+        """ Refreshes the settings if the camera changed its exposure or gain on its own, because ``ExposureAuto`` or
+        ``GainAuto`` is not ``'Off'``. The camera is asked at most every ``auto_check_interval`` seconds, and never
+        if both are off, so the grab loop can call it for every frame.
+        """
+        settings = self.settings
+        if settings.get('exposure_auto', 'Off') == 'Off' and settings.get('gain_auto', 'Off') == 'Off':
+            return
+        now = time.monotonic()
+        if now - self._last_auto_check < self.auto_check_interval:
+            return
+        self._last_auto_check = now
+        # 'Once' goes back to 'Off' by itself when it converges
+        current = (self.get_exposure(), self.get_gain(), self.get_autoexposure(), self.get_autogain())
+        if current != (settings['exposure'], settings['gain'], settings['exposure_auto'], settings['gain_auto']):
+            self.refresh_settings()
+
     def get_acquisition_mode(self):
         return self._acquisition_mode
 
@@ -100,6 +181,7 @@ class BaslerCamera:
         elif mode == self.MODE_SINGLE_SHOT:
             self.logger.debug('Setting buffer to 1')
             self._acquisition_mode = mode
+        self.refresh_settings()
 
     def get_exposure(self):
         return float(self._driver.ExposureTime.Value)
@@ -108,12 +190,14 @@ class BaslerCamera:
         """ Sets exposure time (in micro-s)
         """
         self._driver.ExposureTime.SetValue(exposure)
+        self.refresh_settings()
 
     def get_gain(self):
         return float(self._driver.Gain.Value)
 
     def set_gain(self, gain):
         self._driver.Gain.SetValue(gain)
+        self.refresh_settings()
 
     def get_autoexposure(self):
         return self._driver.ExposureAuto.Value
@@ -123,6 +207,7 @@ class BaslerCamera:
         if mode not in modes:
             raise ValueError(f'Mode must be one of {modes} and not {mode}')
         self._driver.ExposureAuto.SetValue(mode)
+        self.refresh_settings()
 
     def get_autogain(self):
         """ Auto Gain must be one of three values: Off, Once, Continuous"""
@@ -133,6 +218,79 @@ class BaslerCamera:
         if mode not in modes:
             raise ValueError(f'Mode must be one of {modes} and not {mode}')
         self._driver.GainAuto.SetValue(mode)
+        self.refresh_settings()
+
+    def set_trigger(self, source=None, activation='RisingEdge'):
+        """ Starts every frame on an edge of a hardware trigger input, such as ``'Line1'``, or lets the camera run
+        free with None. Cameras wired to the same trigger line acquire their frames at the same time.
+
+        If the camera can count the triggers it receives and send the count with every frame (chunk data), the frame
+        IDs are that count, see :meth:`~_store`. It is reset every time grabbing starts.
+        """
+        if source is None:
+            self._driver.TriggerSelector.SetValue('FrameStart')
+            self._driver.TriggerMode.SetValue('Off')
+            self.trigger_counter = False
+        else:
+            self.logger.info(f'{self} - Frames triggered by {source} ({activation})')
+            self._driver.TriggerSelector.SetValue('FrameStart')
+            self._driver.TriggerMode.SetValue('On')
+            self._driver.TriggerSource.SetValue(source)
+            self._driver.TriggerActivation.SetValue(activation)
+            self.trigger_counter = self._enable_trigger_counter()
+        self.trigger_source = source
+        self.refresh_settings()
+
+    def _enable_trigger_counter(self):
+        """ Makes Counter1 count the frame triggers, and adds its value to the chunk data of every frame. Returns
+        whether the camera supports it. """
+        try:
+            self._driver.CounterSelector.SetValue('Counter1')
+            self._driver.CounterEventSource.SetValue('FrameTrigger')
+            self._driver.CounterResetSource.SetValue('Software')
+            self._driver.ChunkModeActive.SetValue(True)
+            self._driver.ChunkSelector.SetValue('CounterValue')
+            self._driver.ChunkEnable.SetValue(True)
+        except pylon.GenericException as e:
+            self.logger.info(f'{self} - Triggers can not be counted by the camera, they are numbered from the frame '
+                             f'timestamps: {e}')
+            return False
+        return True
+
+    def latch_clock(self):
+        """ Reads the clock of the camera together with the clock of the host, so that frame timestamps can be
+        converted to host time (see :meth:`~host_time`) and compared between cameras. Returns whether the camera
+        supports it.
+        """
+        # USB and GigE cameras name the nodes differently
+        nodes = (('TimestampLatch', 'TimestampLatchValue'), ('GevTimestampControlLatch', 'GevTimestampValue'))
+        for latch, value in nodes:
+            try:
+                before = time.time()
+                getattr(self._driver, latch).Execute()
+                after = time.time()
+                self.clock_reference = ((before + after) / 2, getattr(self._driver, value).GetValue())
+                return True
+            except pylon.LogicalErrorException:
+                continue
+        self.logger.warning(f'{self} - The clock of the camera can not be read')
+        self.clock_reference = None
+        return False
+
+    def host_time(self, timestamp):
+        """ Converts a timestamp of the camera to the time of the host, see :meth:`~latch_clock`. """
+        host_time, ticks = self.clock_reference
+        return host_time + (timestamp - ticks) / self.timestamp_frequency
+
+    def frame_times(self, metadata):
+        """ Host time of each frame, from their rows of metadata in the external buffer. The camera timestamps are
+        used if the clock was latched (see :meth:`~latch_clock`), they don't include the delays of the transfer. If
+        not, the time each frame was stored is used.
+        """
+        timestamps = metadata['timestamp']
+        if self.clock_reference is not None and len(timestamps) and timestamps.min() >= 0:
+            return self.host_time(timestamps)
+        return metadata['host_time'].copy()
 
     def get_width(self):
         return self._driver.Width.Value
@@ -178,30 +336,42 @@ class BaslerCamera:
         self._driver.OffsetY.SetValue(y_pos)
         self.X = (x_pos, x_pos + width)
         self.Y = (y_pos, y_pos + height)
+        self.refresh_settings()
 
     def get_pixelformat(self):
         """ Pixel format and data type for bit depth. This will be used to determine frame size and image arrays type casting """
         pixel_format = self._driver.PixelFormat.GetValue()
-        if pixel_format == 'Mono8' or pixel_format == 'BayerRG8': #or pixel_format == 'YCbCr422_8' or pixel_format == 'BGR8' or pixel_format == 'BGR8':
-            self.current_dtype = np.uint8
-        elif pixel_format == 'Mono12' or pixel_format == 'Mono12p' or pixel_format == 'BayerRG16': # or pixel_format == 'BGR16' or pixel_format == 'BGR16':
-            self.current_dtype = np.uint16
-        else:
-            self.logger.warning(f'Current pixel format is {pixel_format} while only Mono8/12/12p and Bayer8/16 are supported')
+        try:
+            self.current_dtype = pixel_dtype(pixel_format)
+            self.unpacker.pixel_format = pixel_format
+            if self.ingest is not None:
+                self.ingest.pixel_format = pixel_format
+        except ValueError:
+            self.logger.warning(f'Current pixel format is {pixel_format}, which can not be converted to mono')
         return pixel_format
 
     def set_pixelformat(self, mode):
-        if mode not in ('Mono8', 'Mono12', 'BayerRG8'):
-            raise ValueError('Supported modes are Mono8, Mono12, and Bayer8/16')
-
+        """ Sets any pixel format that the ingest stage can convert to mono, see
+        :class:`~elchemi.devices.ingest.ColorToMono`. Packed formats, such as ``Mono12p``, are unpacked to 16 bits
+        on the host, see :class:`~elchemi.devices.ingest.Unpacker`. """
+        ColorToMono(mode)  # Raises ValueError for formats that can't be converted
         self.logger.info(f'Setting pixel format to {mode}')
         self._driver.PixelFormat.SetValue(mode)
-        if mode == 'Mono8' or mode == 'BayerRG8':
-            self.current_dtype = np.uint8
-        elif mode == 'Mono12' or mode == 'Mono12p':
-            self.current_dtype = np.uint16
-        else:
-            self.logger.warning(f'Trying to set pixel_format to {mode}, which is not supported')
+        self.pixel_format = mode
+        self.current_dtype = pixel_dtype(mode)
+        self.unpacker.pixel_format = mode
+        if self.ingest is not None:
+            self.ingest.pixel_format = mode
+        self.refresh_settings()
+
+    def raw_frame_shape(self):
+        """ Shape of the frames as they are grabbed (and transposed), before the ingest stage. """
+        width, height = self.settings['width'], self.settings['height']
+        if self.pixel_format.startswith(('RGB', 'BGR')):
+            return 3, width, height
+        if self.pixel_format.startswith('YCbCr'):
+            return 2 * width, height
+        return width, height
 
     def trigger_camera(self):
         self.logger.info(f'Triggering {self} with mode: {self._acquisition_mode}')
@@ -213,37 +383,31 @@ class BaslerCamera:
         if mode == self.MODE_CONTINUOUS:
             self.logger.info(f'{self} - Triggering Continuous')#, frame: ({self.width},{self.height})')
             # Calculate frame size in bytes
-            frame_size = self.get_width() * self.get_height()
-            if self.current_dtype == np.uint16:
-                if self.pixel_format == 'Mono12' or self.pixel_format == 'Mono12p' or self.pixel_format == 'YCbCr422_8':
-                    frame_size *= 2         # For YCbCr422_8, for every 4 pixels we have 4 Y samples, 2 Cb samples, 2 Cr samples ==> 8 bytes per 4 pixels --> 2 bytes per pixel 
-                if self.pixel_format == 'RGB16' or self.pixel_format == 'BGR16'  or self.pixel_format == 'BayerRG16':
-                    frame_size *= 6
-            elif self.current_dtype == np.uint8:
-                if self.pixel_format == 'RGB8' or self.pixel_format == 'BGR8':
-                    frame_size *= 3
-            elif self.pixel_format == 'BayerRG8':
-                pass
-            else:
+            if self.current_dtype is None:
                 raise CameraException(f'{self} frame dtype is not known to allocate the buffer')
+            # For YCbCr422_8, for every 4 pixels we have 4 Y samples, 2 Cb samples, 2 Cr samples ==> 2 bytes per pixel
+            # Packed formats take only the bits of their pixels, e.g. 1.5 bytes per pixel for Mono12p
+            frame_size = frame_nbytes(self.pixel_format, self.raw_frame_shape())
 
             # Calculate the number of frames to be allocated based on the buffer size (in MB) and the frame size
             # This is useful to keep into account that the frame can be cropped via the ROI or Binning.
             self.logger.info(f'{self} - Frame size: {frame_size} bytes')
             
-            # IF it was possible to find the maximum memory that the camera can allocate to buffers, we use 
-            # that to find the maximum number of buffers it can hold given our image type. If not, we set the 
-            # number of buffers to the maximum (is there a better way to handle this case?) and send a warning so
-            # that user can come and check this in case of slowing down in the camera functions
-            if self.max_buffer_size:
-                max_buffer_number = int(self.buffer_size.m_as('byte')/frame_size)
-                self.logger.info(f'{self} - Calculated max buffer {max_buffer_number}')
-            else:
-                self.logger.warning('Could not retrieve max buffer size, setting number of buffers to maximum')
-                max_buffer_number = self._driver.MaxNumBuffer.GetValue()
+            # MaxBufferSize is the largest size of a single buffer of the driver, every frame must fit in one. The
+            # number of buffers is given by the memory we let the driver use, driver_buffer_budget.
+            if self.max_buffer_size and frame_size > self.max_buffer_size:
+                raise CameraException(f'{self} frames of {frame_size} bytes do not fit in the buffers of the driver, '
+                                      f'of at most {self.max_buffer_size} bytes')
+            max_buffer_number = max(1, int(self.driver_buffer_budget // frame_size))
+            self.logger.info(f'{self} - Calculated max buffer {max_buffer_number}')
 
             self._driver.MaxNumBuffer = max_buffer_number
             self._driver.OutputQueueSize = self._driver.MaxNumBuffer.Value
+            if self.ingest is not None and self.ingest.active:
+                self.allocate_buffer(self.ingest.output_shape(self.raw_frame_shape()),
+                                     self.ingest.output_dtype(self.current_dtype))
+            else:
+                self.allocate_buffer(self.raw_frame_shape(), self.current_dtype)
             self._driver.StartGrabbing(pylon.GrabStrategy_OneByOne)
             self.logger.info('Grab Strategy: One by One')
             self.logger.info(f'Output Queue Size: {self._driver.MaxNumBuffer.Value}')
@@ -259,80 +423,210 @@ class BaslerCamera:
             self.logger.info('Grab Strategy: Latest Images')
         else:
             raise CameraException('Unknown acquisition mode')
+        # The queue size changed, and the camera only knows its resulting frame rate once it grabs
+        self.refresh_settings()
+        self._last_trigger = None
+        self._counter_offset = None
+        if self.trigger_counter:
+            self._driver.CounterReset.Execute()
 
         # self._driver.ExecuteSoftwareTrigger()
         self.logger.info('Executed Software Trigger')
 
+    def allocate_buffer(self, frame_shape, dtype):
+        """ Makes sure that the external buffer can hold frames of the given shape and dtype. A new buffer is only
+        allocated if there was none or if the frames changed, for example after changing the ROI or the pixel format.
+        """
+        buffer = self.external_buffer
+        if buffer is not None and buffer.frame_shape == tuple(frame_shape) and buffer.dtype == dtype:
+            return
+        if isinstance(self.external_buffer_size, str):
+            self.external_buffer = CircularBuffer.from_budget(self.external_buffer_size, frame_shape, dtype,
+                                                              name=str(self), shared=self.shared_buffer,
+                                                              on_disk=self.buffer_on_disk)
+        else:
+            self.external_buffer = CircularBuffer(self.external_buffer_size, frame_shape, dtype, name=str(self),
+                                                  shared=self.shared_buffer, on_disk=self.buffer_on_disk)
+        self.logger.info(f'{self} - Allocated buffer of {self.external_buffer.length} frames of {frame_shape} {dtype}, '
+                         f'{self.external_buffer.nbytes / 1024**2:.1f} MiB')
+        if buffer is not None:
+            buffer.close()
+
+    def _store(self, frame, grab):
+        """ Writes the frame in the next slot of the external buffer, together with the timestamp, ID and status of the
+        grab result. They are already in the grab result, so no node of the camera is read. If there is an ingest
+        stage, it writes the reduced frame directly in the slot, and frames discarded by its decimation are not stored.
+
+        Returns the view on the slot, or None if the frame was discarded.
+        """
+        frame_id = grab.GetBlockID()
+        if self.trigger_counter:
+            frame_id = self._trigger_count(grab)
+        elif self.trigger_frequency:
+            frame_id = self._trigger_index(grab.GetTimeStamp())
+        ingest = self.ingest if self.ingest is not None and self.ingest.active else None
+        if ingest is not None:
+            if not ingest.keep(frame_id):
+                return None
+            frame_id = ingest.stored_id(frame_id)
+            self.allocate_buffer(ingest.output_shape(frame.shape), ingest.output_dtype(frame.dtype))
+        else:
+            self.allocate_buffer(frame.shape, frame.dtype)
+        with self.external_buffer.writing(timestamp=grab.GetTimeStamp(), frame_id=frame_id,
+                                          status=grab.GetErrorCode(),
+                                          settings_version=self.settings_version) as slot:
+            if ingest is not None:
+                ingest.reduce(frame, out=slot)
+            else:
+                np.copyto(slot, frame, casting='unsafe')
+        return slot
+
+    def _trigger_count(self, grab):
+        """ Number of the hardware trigger that started a frame, from the trigger counter sent by the camera. The
+        counter also counts the triggers for which the camera did not acquire a frame, including the ones before its
+        first frame, so cameras on the same trigger line give the same number to the frames of the same trigger.
+
+        If the camera shares a ``trigger_reference`` and its clock was latched, the first frame is numbered like in
+        :meth:`~_trigger_index` and the counter only gives the steps from there, so that the cameras that count their
+        triggers and the ones that can't number them alike.
+        """
+        try:
+            count = int(grab.ChunkCounterValue.Value) - 1
+        except pylon.GenericException:
+            self.logger.warning(f'{self} - The frames do not carry the trigger counter, using the frame timestamps')
+            self.trigger_counter = False
+            return self._trigger_index(grab.GetTimeStamp()) if self.trigger_frequency else grab.GetBlockID()
+        if self._counter_offset is None:
+            self._counter_offset = 0
+            if self.trigger_reference is not None and self.clock_reference is not None and self.trigger_frequency:
+                index = self.trigger_reference.index(self.host_time(grab.GetTimeStamp()), self.trigger_frequency,
+                                                     count=count)
+                self._counter_offset = index - count
+        return count + self._counter_offset
+
+    def _trigger_index(self, timestamp):
+        """ Number of the hardware trigger that started a frame, when the camera can not count them. It is derived
+        from the time since the previous frame and the ``trigger_frequency``, so unlike the block ID it skips the
+        triggers the camera missed.
+
+        The first frame is numbered 0, unless the camera shares a ``trigger_reference`` with other cameras (see
+        :class:`~elchemi.devices.camera.array.CameraArray`) and its clock was latched to the host clock: then it is
+        numbered from its time relative to the first frame of any of the cameras, so that a camera that missed the
+        first triggers still gives the same numbers as the others to the frames of the same trigger.
+        """
+        if self._last_trigger is None:
+            if self.trigger_reference is not None and self.clock_reference is not None:
+                index = self.trigger_reference.index(self.host_time(timestamp), self.trigger_frequency)
+            else:
+                index = 0
+        else:
+            last_index, last_timestamp = self._last_trigger
+            periods = (timestamp - last_timestamp) * self.trigger_frequency / self.timestamp_frequency
+            index = last_index + max(1, int(round(periods)))
+        self._last_trigger = (index, timestamp)
+        return index
+
+    def measured_frame_rate(self, N=None):
+        """ Frame rate of the last N frames in the external buffer, from their timestamps. If there are not enough
+        frames, it returns the frame rate of the camera settings. """
+        frame_rate = np.nan
+        if self.external_buffer is not None:
+            frame_rate = self.external_buffer.frame_rate(N, tick_frequency=self.timestamp_frequency)
+        if np.isnan(frame_rate):
+            frame_rate = self.settings.get('frame_rate', np.nan)
+        return frame_rate
+
     def get_frame_rate(self):
         return  self._driver.ResultingFrameRate.GetValue()
     
     def set_framerate(self, frame_rate):
         self._driver.AcquisitionFrameRate.SetValue(frame_rate)
+        self.refresh_settings()
+
+    def _handle_grab(self, grab):
+        """ Stores the frame of a grab result. The caller releases the result. Returns a view on the frame in the
+        external buffer, or None if the grab failed or the frame was discarded by the ingest stage. """
+        if not grab.GrabSucceeded():
+            self.logger.error(f'{self}: Grabbing failed {grab.ErrorDescription}')
+            return None
+        if self.unpacker.active:
+            # Packed pixels are unpacked straight from the memory of the driver into a reused frame, which is then
+            # stored. The buffer slots hold frames transposed, so the pixels can't be unpacked in the slot itself.
+            with grab.GetArrayZeroCopy(raw=True) as payload:
+                raw = self.unpacker.unpack(payload, (self.settings['height'], self.settings['width']))
+            frame = self._store(raw.T, grab)
+        else:
+            # The array is the memory of the driver: it is copied once, already transposed, into the buffer slot, and
+            # must not be used after the block
+            with grab.GetArrayZeroCopy() as raw:
+                frame = self._store(raw.T, grab)
+        return frame
+
+    @property
+    def temp_image(self):
+        """ Copy of the last frame stored in the external buffer, for display, or None if there is none. Frames in the
+        buffer are overwritten as the acquisition goes on, a view could change while it is displayed. """
+        if self.external_buffer is None:
+            return None
+        return self.external_buffer.copy_latest()
 
     def read_camera(self) -> list:
+        """ Retrieves the frames that the camera has ready. The settings come from the snapshot kept by
+        :meth:`~refresh_settings`, so no node of the camera is read here, except for the settings under automatic
+        control, see :meth:`~follow_auto`. """
         img = []
-        mode = self.get_acquisition_mode()
-        exposure = self.get_exposure()   # Exposure in milliseconds
-        self.logger.debug(f'Grabbing mode: {mode}')
+        self.follow_auto()
+        settings = self.settings
+        mode = settings['acquisition_mode']
+        timeout = int(settings['exposure'] / 1000) + self.grab_timeout  # Exposure is in us, the timeout in ms
         if mode == self.MODE_SINGLE_SHOT or mode == self.MODE_LAST and self._driver.IsGrabbing():
-            grab = self._driver.RetrieveResult(int(exposure), pylon.TimeoutHandling_Return)
-            if grab and grab.GrabSucceeded():
-                img = [grab.GetArray().T]
-                self.temp_image = img[-1]
-                self.external_buffer.frame_rates.append(self.get_frame_rate())
-                self.external_buffer.put(img)
+            grab = self._driver.RetrieveResult(timeout, pylon.TimeoutHandling_Return)
+            if grab and grab.IsValid():
+                frame = self._handle_grab(grab)
                 grab.Release()
+                if frame is not None:
+                    img = [frame]
             if mode == self.MODE_SINGLE_SHOT:
                 self._driver.StopGrabbing()
             return img
         else:
             if not self._driver.IsGrabbing():
                 raise WrongCameraState('You need to trigger the camera before reading')
-            num_buffers = self._driver.NumReadyBuffers.Value
-            print('Num Buffers %s'%num_buffers)
-            if num_buffers > 0:
-                if num_buffers > 0.9*self._driver.OutputQueueSize.Value:
-                    self.logger.warning(f'{self} Basler Buffer filled to 90% num buffers: {num_buffers}')
-                img = [np.zeros((self.width, self.height), dtype=self.current_dtype)] * num_buffers
-                tot_frames = 0
-                for i in range(num_buffers):
-                    grab = self._driver.RetrieveResult(int(exposure + 100), pylon.TimeoutHandling_ThrowException)
-                    if grab:
-                        if grab.GrabSucceeded():
-                            img[i] = grab.GetArray().T
-                            self.temp_image = img[i]
-                            if not self.external_buffer.pause_storage.is_set():
-                                self.external_buffer.frame_rates.append(self.get_frame_rate())
-                                self.external_buffer.put(img)
-                            grab.Release()
-                            tot_frames += 1
-                        else:
-                            self.logger.error(f'{self}: Grabbing failed {grab.ErrorDescription}')
-                    # else:
-                    #     if np.any(self.temp_image):
-                    #         if np.all(self.temp_image == img[i]):
-                    #             self.logger.error('Duplicated frame grabbed from Basler')
-                if tot_frames != num_buffers:
-                    self.logger.warning(f'{self}: Number of buffers: {num_buffers} but number of frames read: {tot_frames}')
-                img = img[:tot_frames]
-        if len(img) >= 1:
-            self.temp_image = img[-1]
+            # Drains the frames already waiting, without asking the camera how many there are. At most one queue
+            # is read, so that a camera faster than the reader does not keep it here forever
+            for _ in range(settings['output_queue_size']):
+                grab = self._driver.RetrieveResult(0, pylon.TimeoutHandling_Return)
+                if not grab or not grab.IsValid():
+                    break
+                try:
+                    frame = self._handle_grab(grab)
+                finally:
+                    grab.Release()
+                if frame is not None:
+                    img.append(frame)
+            if len(img) > 0.9 * settings['output_queue_size']:
+                self.logger.warning(f'{self} Basler Buffer filled to 90% num buffers: {len(img)}')
         return img
 
     def continuous_reads(self):
+        """ Grab loop, running in its own thread. Grabbing is started only once, by :meth:`~start_continuous_reads`,
+        and the loop blocks in ``RetrieveResult`` until the camera delivers the next frame, so there is no polling and
+        no restart between frames. Each result is stored and released right away, giving its buffer back to pylon.
+        """
         self.keep_reading = True
         self.continuous_reads_running = True
-        i = 0
-        while not self._stop_read.is_set():
-            
-            i += 1
-            self.trigger_camera()
-            imgs = self.read_camera()
-            
-            if len(imgs) >= 1:
-                self.temp_image = imgs[-1]
-            time.sleep(.001)
-        self.continuous_reads_running = False
+        try:
+            while not self._stop_read.is_set() and self._driver.IsGrabbing():
+                grab = self._driver.RetrieveResult(self.grab_timeout, pylon.TimeoutHandling_Return)
+                if not grab or not grab.IsValid():
+                    continue  # Timed out, check again if the loop has to stop
+                try:
+                    self._handle_grab(grab)
+                finally:
+                    grab.Release()
+                self.follow_auto()
+        finally:
+            self.continuous_reads_running = False
 
     def start_continuous_reads(self):
         if self.continuous_reads_running:
@@ -380,6 +674,8 @@ class BaslerCamera:
 
         self.stop_continuous_reads()
         self._driver.StopGrabbing()
+        if self.external_buffer is not None:
+            self.external_buffer.close()
         self.finalized = True
 
     def __str__(self):
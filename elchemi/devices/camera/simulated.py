@@ -0,0 +1,373 @@
+"""
+Simulated camera
+================
+
+Stand-in for the pylon ``InstantCamera`` that :class:`~elchemi.devices.camera.basler.BaslerCamera` drives, so that the
+acquisition, the frame buffers and the live analysis can be developed, benchmarked and tested without a camera. It
+is used through :class:`SimulatedBaslerCamera`, which runs exactly the same code as
+the real camera from the grab results onwards.
+
+The scene is a background with a set of round sites whose intensity is modulated at a given frequency and phase,
+plus noise. To reach thousands of frames per second, the noiseless frames are rendered once for ``phase_steps``
+points of the modulation period, and a bank of noise frames is rendered once as well. Every frame is then a single
+integer addition of one of each, written directly into the buffer of the grab result.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from logging import getLogger
+
+import numpy as np
+
+from elchemi.devices.camera.basler import BaslerCamera
+from elchemi.devices.ingest import is_packed, pack_bits, pixel_bits, pixel_dtype
+
+
+class ModulatedScene:
+    PIXEL_FORMATS = ('Mono8', 'Mono10p', 'Mono12', 'Mono12p', 'BayerRG8', 'BayerRG12', 'BayerRG12p', 'RGB8', 'BGR8')
+
+    def __init__(self, width=512, height=512, sites=20, site_radius=6., background=0.2, modulation=0.05,
+                 frequency=10., phase=0., noise=0.01, phase_steps=64, noise_frames=16, seed=None):
+        """ Describes the simulated scene. Intensities are fractions of the full scale of the pixel format.
+
+        Parameters
+        ----------
+        width, height : int
+            Size of the sensor, in pixels
+        sites : int
+            Number of modulated sites, placed at random
+        site_radius : float
+            Radius of each site, in pixels
+        background : float
+            Intensity of the pixels outside the sites
+        modulation : float
+            Amplitude of the modulation at the centre of the sites
+        frequency : float
+            Frequency of the modulation, in Hz
+        phase : float
+            Phase of the modulation at time 0, in radians
+        noise : float
+            Standard deviation of the noise
+        phase_steps : int
+            Number of frames rendered for a modulation period
+        noise_frames : int
+            Number of noise frames rendered, every frame takes one of them at random
+        seed : int or None
+            Seed of the random generator, to repeat the same scene
+        """
+        self.width = int(width)
+        self.height = int(height)
+        self.frequency = frequency
+        self.phase = phase
+        self.background = background
+        self.modulation = modulation
+        self.noise = noise
+        self.phase_steps = int(phase_steps)
+        self.noise_frames = int(noise_frames)
+        self.rng = np.random.default_rng(seed)
+
+        rows, cols = np.mgrid[:self.height, :self.width]
+        self.site_map = np.zeros((self.height, self.width), dtype=np.float32)
+        self.sites = np.column_stack([self.rng.uniform(0, self.height, sites), self.rng.uniform(0, self.width, sites)])
+        for row, col in self.sites:
+            self.site_map += np.exp(-((rows - row) ** 2 + (cols - col) ** 2) / (2 * site_radius ** 2))
+        np.clip(self.site_map, 0, 1, out=self.site_map)
+
+        self.pixel_format = None
+        self.start_time = None  # Host time of t = 0, set when a camera starts grabbing
+        self._clean = None
+        self._noise = None
+
+    @property
+    def modulation_reference(self):
+        """ ``(start time, frequency, phase)`` of the modulation, like
+        :attr:`~elchemi.devices.DAQ.waveforms.DwfController.modulation_reference`, or None before any camera starts
+        grabbing.
+        """
+        if self.start_time is None:
+            return None
+        return self.start_time, self.frequency, self.phase
+
+    def render(self, pixel_format):
+        """ Renders the noiseless frames and the noise bank for a pixel format. Values are kept far enough from 0 and
+        from the full scale that adding the noise never wraps around. """
+        if pixel_format not in self.PIXEL_FORMATS:
+            raise ValueError(f'The simulated camera supports {self.PIXEL_FORMATS}, not {pixel_format}')
+        dtype = pixel_dtype(pixel_format)
+        full_scale = 2 ** pixel_bits(pixel_format) - 1
+        margin = int(np.ceil(3 * self.noise * full_scale))
+
+        phases = 2 * np.pi * np.arange(self.phase_steps) / self.phase_steps
+        clean = self.background + self.modulation * np.sin(phases)[:, None, None] * self.site_map
+        clean = np.clip(np.rint(clean * full_scale), margin, full_scale - margin) - margin
+        noise = self.rng.normal(0, self.noise * full_scale, (self.noise_frames, self.height, self.width))
+        noise = np.clip(np.rint(noise), -margin, margin) + margin
+        if pixel_format.startswith(('RGB', 'BGR')):
+            clean = np.repeat(clean[..., None], 3, axis=-1)
+            noise = np.repeat(noise[..., None], 3, axis=-1)
+        self._clean = clean.astype(dtype)
+        self._noise = noise.astype(dtype)
+        self.pixel_format = pixel_format
+
+    def frame_shape(self, roi):
+        """ Shape of the frames of the grab results for the ROI ``(offset_x, offset_y, width, height)``. """
+        shape = (roi[3], roi[2])
+        return (*shape, 3) if self.pixel_format.startswith(('RGB', 'BGR')) else shape
+
+    def draw(self, t, roi, out):
+        """ Writes the frame at time t, in seconds, cropped to the ROI ``(offset_x, offset_y, width, height)``. """
+        x, y, width, height = roi
+        step = int(((self.frequency * t + self.phase / (2 * np.pi)) % 1) * self.phase_steps) % self.phase_steps
+        noise = self.rng.integers(self.noise_frames)
+        np.add(self._clean[step, y:y + height, x:x + width], self._noise[noise, y:y + height, x:x + width], out=out)
+        return out
+
+
+class SimulatedNode:
+    """ Mimics a GenICam node: a value that can be read and written, with optional limits and symbolic values. A
+    command node calls its ``setter`` when it is executed. """
+    def __init__(self, value=0, minimum=None, maximum=None, symbolics=None, getter=None, setter=None):
+        self._value = value
+        self.minimum = minimum
+        self.maximum = maximum
+        self.symbolics = symbolics
+        self.getter = getter
+        self.setter = setter
+
+    def GetValue(self):
+        return self.getter() if self.getter is not None else self._value
+
+    def SetValue(self, value):
+        if self.symbolics is not None and value not in self.symbolics:
+            raise ValueError(f'{value} is not one of {self.symbolics}')
+        if self.minimum is not None:
+            value = max(self.minimum, value)
+        if self.maximum is not None:
+            value = min(self.maximum, value)
+        self._value = value
+        if self.setter is not None:
+            self.setter(value)
+
+    Value = property(GetValue, SetValue)
+
+    def Execute(self):
+        if self.setter is not None:
+            self.setter(self._value)
+
+    def GetMin(self):
+        return self.minimum
+
+    def GetMax(self):
+        return self.maximum
+
+    def GetInc(self):
+        return 1
+
+    def GetSymbolics(self):
+        return list(self.symbolics or [])
+
+
+class SimulatedGrabResult:
+    """ Mimics the pylon ``GrabResult`` used by :class:`~elchemi.devices.camera.basler.BaslerCamera`. """
+    def __init__(self, array=None, frame_id=-1, timestamp=-1, pixel_format=None, trigger_count=None):
+        self.array = array
+        self.pixel_format = pixel_format
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        if trigger_count is not None:
+            self.ChunkCounterValue = SimulatedNode(trigger_count)
+        self.ErrorDescription = '' if array is not None else 'Timeout'
+
+    def IsValid(self):
+        return self.array is not None
+
+    def GrabSucceeded(self):
+        return self.array is not None
+
+    def GetErrorCode(self):
+        return 0 if self.array is not None else 1
+
+    def GetBlockID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        return self.timestamp
+
+    def GetArray(self):
+        return self.array.copy()
+
+    @property
+    def Array(self):
+        return self.GetArray()
+
+    def GetBuffer(self):
+        """ The payload as the camera sends it, packed for packed pixel formats. """
+        if is_packed(self.pixel_format):
+            return pack_bits(self.array, pixel_bits(self.pixel_format))
+        return self.array.tobytes()
+
+    @contextmanager
+    def GetArrayZeroCopy(self, raw=False):
+        """ The frame, or with ``raw`` the payload as a flat array of bytes, packed for packed pixel formats. """
+        if raw:
+            yield np.frombuffer(self.GetBuffer(), dtype=np.uint8)
+        else:
+            yield self.array
+
+    def Release(self):
+        self.array = None
+
+
+class SimulatedInstantCamera:
+    """ Mimics the parts of pylon's ``InstantCamera`` that :class:`~elchemi.devices.camera.basler.BaslerCamera` uses.
+
+    Frames are delivered at the ``AcquisitionFrameRate``, with IDs and timestamps (in ns) as a real camera would give
+    them. If the reader falls behind by more than ``OutputQueueSize`` frames, the oldest frames are lost and their IDs
+    are skipped. A frame rate of 0 delivers frames as fast as they are requested. Its clock can be latched, and with
+    chunks active, every frame also carries the count of (simulated) triggers.
+    """
+    def __init__(self, scene=None, frame_rate=1000.):
+        self.logger = getLogger(__name__)
+        self.scene = scene or ModulatedScene()
+        self._grabbing = False
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._clock_origin = time.perf_counter()  # The clock of the camera keeps running between acquisitions
+        self._start_time = 0
+        self._pool = []
+
+        self.WidthMax = SimulatedNode(self.scene.width)
+        self.HeightMax = SimulatedNode(self.scene.height)
+        self.Width = SimulatedNode(self.scene.width, 1, self.scene.width)
+        self.Height = SimulatedNode(self.scene.height, 1, self.scene.height)
+        self.OffsetX = SimulatedNode(0, 0, self.scene.width - 1)
+        self.OffsetY = SimulatedNode(0, 0, self.scene.height - 1)
+        self.PixelFormat = SimulatedNode('Mono8', symbolics=ModulatedScene.PIXEL_FORMATS, setter=self.scene.render)
+        self.AcquisitionFrameRate = SimulatedNode(frame_rate, 0)
+        self.ResultingFrameRate = SimulatedNode(getter=self.AcquisitionFrameRate.GetValue)
+        self.ExposureTime = SimulatedNode(100., 1.)
+        self.Gain = SimulatedNode(0.)
+        self.ExposureAuto = SimulatedNode('Off', symbolics=('Off', 'Once', 'Continuous'))
+        self.GainAuto = SimulatedNode('Off', symbolics=('Off', 'Once', 'Continuous'))
+        self.MaxNumBuffer = SimulatedNode(10, 1)
+        self.OutputQueueSize = SimulatedNode(10, 1)
+        self.NumReadyBuffers = SimulatedNode(getter=self._ready_frames)
+        self.MaxBufferSize = SimulatedNode(64 * 1024 ** 2)  # Largest size of a single buffer of the driver, in bytes
+        self.GevTimestampTickFrequency = SimulatedNode(int(1e9))
+        self.TimestampLatch = SimulatedNode(setter=self._latch_timestamp)
+        self.TimestampLatchValue = SimulatedNode(0)
+        self.ChunkModeActive = SimulatedNode(False)
+        self.scene.render(self.PixelFormat.GetValue())
+
+    def __getattr__(self, name):
+        """ Any other node, for example the ones of the digital lines, is created when it is first used. """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        node = SimulatedNode()
+        setattr(self, name, node)
+        return node
+
+    def __setattr__(self, name, value):
+        """ As with pypylon, assigning a value to a node sets its value. """
+        node = self.__dict__.get(name)
+        if isinstance(node, SimulatedNode) and not isinstance(value, SimulatedNode):
+            node.SetValue(value)
+        else:
+            super().__setattr__(name, value)
+
+    def GetDeviceInfo(self):
+        class DeviceInfo:
+            def GetModelName(self):
+                return 'Simulated camera'
+        return DeviceInfo()
+
+    def GetNodeMap(self):
+        return self
+
+    def GetNode(self, name):
+        return getattr(self, name)
+
+    def Open(self):
+        pass
+
+    def Close(self):
+        self.StopGrabbing()
+
+    def IsGrabbing(self):
+        return self._grabbing
+
+    def _latch_timestamp(self, _):
+        self.TimestampLatchValue.SetValue(int((time.perf_counter() - self._clock_origin) * 1e9))
+
+    def _roi(self):
+        return self.OffsetX.Value, self.OffsetY.Value, self.Width.Value, self.Height.Value
+
+    def StartGrabbing(self, *args):
+        with self._lock:
+            shape = self.scene.frame_shape(self._roi())
+            dtype = pixel_dtype(self.scene.pixel_format)
+            self._pool = [np.empty(shape, dtype=dtype) for _ in range(max(1, self.MaxNumBuffer.Value))]
+            self._next_id = 0
+            self._start_time = time.perf_counter()
+            self.scene.start_time = time.time()
+            self._grabbing = True
+
+    def StopGrabbing(self):
+        self._grabbing = False
+
+    def _ready_frames(self):
+        if not self._grabbing or not self.AcquisitionFrameRate.Value:
+            return 0
+        due = int((time.perf_counter() - self._start_time) * self.AcquisitionFrameRate.Value) + 1
+        return int(np.clip(due - self._next_id, 0, self.OutputQueueSize.Value))
+
+    def RetrieveResult(self, timeout, *args):
+        """ Waits for the next frame, up to ``timeout`` ms. On timeout it returns an invalid result. """
+        with self._lock:
+            if not self._grabbing:
+                return SimulatedGrabResult()
+            frame_rate = self.AcquisitionFrameRate.Value
+            frame_id = self._next_id
+            now = time.perf_counter() - self._start_time
+            if frame_rate:
+                queue = self.OutputQueueSize.Value
+                if now * frame_rate - frame_id > queue:
+                    # The reader is too slow, frames that did not fit in the output queue are lost
+                    frame_id = int(now * frame_rate) - queue + 1
+                wait = frame_id / frame_rate - now
+                if wait > timeout / 1000:
+                    time.sleep(timeout / 1000)
+                    return SimulatedGrabResult()
+                if wait > 0:
+                    time.sleep(wait)
+                t = frame_id / frame_rate
+            else:
+                t = now
+            self._next_id = frame_id + 1
+            out = self._pool[frame_id % len(self._pool)]
+            self.scene.draw(t, self._roi(), out)
+            timestamp = int((self._start_time - self._clock_origin + t) * 1e9)
+            trigger_count = frame_id + 1 if self.ChunkModeActive.Value else None
+            return SimulatedGrabResult(out, frame_id, timestamp, self.scene.pixel_format, trigger_count)
+
+
+class SimulatedBaslerCamera(BaslerCamera):
+    """ Camera with the same API as :class:`~elchemi.devices.camera.basler.BaslerCamera`, but driving a
+    :class:`SimulatedInstantCamera` that films a :class:`ModulatedScene`. Everything from the grab results onwards
+    (ingest, buffers, metadata, analysis) runs the code of the real camera, so it can be used to develop and benchmark
+    the acquisition without hardware.
+    """
+    def __init__(self, camera: str = 'Simulated', external_buffer_size=500, initial_config: dict={}, scene=None,
+                 frame_rate=1000., **kwargs):
+        """ ``scene`` is a :class:`ModulatedScene`, and ``frame_rate`` the frame rate of the simulated camera, 0 for as
+        fast as possible. Other arguments are the ones of :class:`~elchemi.devices.camera.basler.BaslerCamera`. """
+        super().__init__(camera, external_buffer_size, initial_config, **kwargs)
+        self.scene = scene if scene is not None else ModulatedScene()
+        self.simulated_frame_rate = frame_rate
+
+    def initialize(self):
+        self.logger.debug('Initializing simulated Basler Camera')
+        self._driver = SimulatedInstantCamera(self.scene, self.simulated_frame_rate)
+        self._driver.Open()
+        self.friendly_name = f'{self.camera} (simulated)'
+        self._load_settings()
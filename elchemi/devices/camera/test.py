@@ -22,5 +22,35 @@ def test_camera():
     
     camera.StopGrabbing()
 
+def test_camera_array():
+    """ Aligns the frames of two simulated cameras while they run, one counting its triggers and the other numbering
+    them from its timestamps. The buffers are short, so the oldest frames are overwritten while they are read. """
+    import time
+    from elchemi.devices.camera.array import CameraArray
+    from elchemi.devices.camera.simulated import ModulatedScene, SimulatedBaslerCamera
+
+    cameras = [SimulatedBaslerCamera(f'Simulated {i}', 20, scene=ModulatedScene(64, 64, seed=i), frame_rate=100)
+               for i in range(2)]
+    array = CameraArray(cameras)
+    array.initialize()
+    cameras[1].trigger_counter = False
+    array.start(100)
+    try:
+        time.sleep(0.3)
+        for _ in range(20):
+            triggers, frames = array.aligned_frames()
+            assert len(triggers) > 0
+            assert np.all(np.diff(triggers) > 0)
+            assert all(len(camera_frames) == len(triggers) for camera_frames in frames)
+            # Both numbering schemes give the same number to frames acquired at the same time
+            last = [buffer.get_last_metadata(1)['frame_id'][0] for buffer in array.buffers]
+            assert abs(last[0] - last[1]) <= 1, last
+            time.sleep(0.01)
+        print('Aligned', len(triggers), 'triggers, last', triggers[-1])
+    finally:
+        array.finalize()
+
+
 if __name__ == "__main__":
     test_camera()
+    test_camera_array()
@@ -0,0 +1,390 @@
+"""
+Ingest stage
+============
+
+Reduces the frames coming from the camera before they are stored in the frame buffer. The analysis often works at a
+lower spatial resolution than the sensor, and a smaller frame makes the buffer hold a longer history and the FFT
+cheaper by the same factor.
+
+Packed pixel formats (``Mono10p``, ``Mono12p``, ``BayerRG12p``...) pack the pixels without padding bits, 12-bit
+pixels take 1.5 bytes instead of 2, which lowers the bandwidth of the camera link by 25%. They are unpacked on the host
+into 16-bit frames by :class:`Unpacker`, before the rest of the stage.
+
+The stage first converts colour frames to a single channel (see :class:`ColorToMono`), then crops the frame to the
+region that is analyzed, sums blocks of NxN pixels into an integer type wide enough
+to hold the sum, and can keep only one frame out of every ``decimation``. The outputs are preallocated, so no memory is
+allocated for every frame. The result is only valid until the next frame is processed, it is meant to be copied into
+the buffer right away.
+"""
+import re
+from logging import getLogger
+from math import gcd
+
+import numpy as np
+
+
+def binned_dtype(dtype, pixels):
+    """ Smallest integer type that can hold the sum of ``pixels`` values of the given integer dtype. Floats are kept
+    as they are.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'ui':
+        return dtype
+    max_value = int(np.iinfo(dtype).max) * pixels
+    candidates = (np.uint8, np.uint16, np.uint32, np.uint64) if dtype.kind == 'u' else \
+        (np.int8, np.int16, np.int32, np.int64)
+    for candidate in candidates:
+        if np.iinfo(candidate).max >= max_value:
+            return np.dtype(candidate)
+    return np.dtype(candidates[-1])
+
+
+def pixel_bits(pixel_format):
+    """ Number of significant bits per channel of a pixel format, e.g. 12 for ``'BayerRG12'`` or ``'Mono12p'``. """
+    match = re.search(r'(\d+)(?:p|packed)?$', pixel_format.split('_')[-1], re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Can not tell the bit depth of {pixel_format}')
+    return int(match.group(1))
+
+
+def pixel_dtype(pixel_format):
+    """ Type of the arrays that the camera gives for a pixel format. """
+    return np.dtype(np.uint8 if pixel_bits(pixel_format) <= 8 else np.uint16)
+
+
+def is_packed(pixel_format):
+    """ Whether the pixels of a format are packed without padding bits, as in ``'Mono12p'``. """
+    return pixel_format is not None and re.search(r'\d+p$', pixel_format) is not None
+
+
+def frame_nbytes(pixel_format, shape):
+    """ Size in bytes of the payload of a frame of the given shape, taking packing into account. """
+    pixels = int(np.prod(shape))
+    if is_packed(pixel_format):
+        return -(-pixels * pixel_bits(pixel_format) // 8)
+    return pixels * pixel_dtype(pixel_format).itemsize
+
+
+def _packing(bits):
+    """ Number of pixels and of bytes of the smallest group of packed pixels that ends on a byte boundary. """
+    pixels = 8 // gcd(bits, 8)
+    return pixels, pixels * bits // 8
+
+
+def unpack_bits(raw, bits, out, work=None):
+    """ Unpacks pixels of ``bits`` bits, packed LSB first as in the GenICam ``Mono10p``, ``Mono12p`` or ``BayerRG12p``
+    formats, into the integer array ``out``. For 12 bits, for example, every 3 bytes hold 2 pixels::
+
+        p0 = b0 | (b1 & 0x0F) << 8
+        p1 = b1 >> 4 | b2 << 4
+
+    Every pixel of a group is computed for all the groups at once, directly in ``out``, so no array of the size of
+    the frame is allocated. Pixels that span two bytes are read as unaligned little-endian 16-bit words, so each of
+    them takes a shift and a mask.
+
+    Parameters
+    ----------
+    raw : bytes or numpy.array
+        Packed payload, with at least ``out.size * bits / 8`` bytes
+    bits : int
+        Bits per pixel
+    out : numpy.array
+        Contiguous array of unsigned integers of at least ``bits`` bits, it defines the number of pixels to unpack
+    work : numpy.array or None
+        Array with one element of the type of ``out`` per group of pixels, allocated if not given
+
+    Returns
+    -------
+    numpy.array
+        out
+    """
+    group_pixels, group_bytes = _packing(bits)
+    if out.size % group_pixels:
+        raise ValueError(f'The number of pixels must be a multiple of {group_pixels} to unpack {bits} bits')
+    groups = out.size // group_pixels
+    raw = np.frombuffer(raw, dtype=np.uint8, count=groups * group_bytes)
+    pixels = out.reshape(groups, group_pixels)
+    if not np.shares_memory(pixels, out):
+        raise ValueError('The output of the unpacking must be contiguous')
+    mask = (1 << bits) - 1
+    for k in range(group_pixels):
+        first, shift = divmod(k * bits, 8)
+        last = (k * bits + bits - 1) // 8
+        pixel = pixels[:, k]
+        if last == first + 1:
+            words = np.ndarray((groups,), dtype='<u2', buffer=raw, offset=first, strides=(group_bytes,))
+            np.right_shift(words, shift, out=pixel)
+        else:
+            if work is None:
+                work = np.empty(groups, dtype=out.dtype)
+            np.right_shift(raw[first::group_bytes], shift, out=pixel)
+            for byte in range(first + 1, last + 1):
+                np.copyto(work, raw[byte::group_bytes])
+                work <<= 8 * (byte - first) - shift
+                pixel |= work
+        pixel &= mask
+    return out
+
+
+def pack_bits(frame, bits):
+    """ Packs the pixels of an integer frame into ``bits`` bits each, the inverse of :func:`unpack_bits`. It is meant
+    for simulations and tests, not for the acquisition. """
+    group_pixels, group_bytes = _packing(bits)
+    pixels = np.ascontiguousarray(frame).reshape(-1, group_pixels).astype(np.uint32)
+    packed = np.zeros((len(pixels), group_bytes), dtype=np.uint32)
+    for k in range(group_pixels):
+        first, shift = divmod(k * bits, 8)
+        last = (k * bits + bits - 1) // 8
+        for byte in range(first, last + 1):
+            offset = 8 * (byte - first) - shift
+            packed[:, byte] |= (pixels[:, k] << -offset if offset < 0 else pixels[:, k] >> offset) & 0xFF
+    return packed.astype(np.uint8).tobytes()
+
+
+class Unpacker:
+    """ Unpacks the payloads of a packed pixel format into frames of 16-bit integers, reusing the same output for
+    every frame. Formats that are not packed are not handled, see :func:`is_packed`.
+    """
+    def __init__(self, pixel_format=None):
+        self.pixel_format = pixel_format
+        self._output = None
+        self._work = None
+
+    @property
+    def pixel_format(self):
+        return self._pixel_format
+
+    @pixel_format.setter
+    def pixel_format(self, pixel_format):
+        self._pixel_format = pixel_format if is_packed(pixel_format) else None
+
+    @property
+    def active(self):
+        return self.pixel_format is not None
+
+    def unpack(self, raw, shape):
+        """ Unpacks a payload into a frame of the given shape, ``(rows, columns)`` as the camera sends it. The frame is
+        only valid until the next payload is unpacked. """
+        shape = tuple(shape)
+        if self._output is None or self._output.shape != shape:
+            self._output = np.empty(shape, dtype=pixel_dtype(self.pixel_format))
+            self._work = np.empty(self._output.size // _packing(pixel_bits(self.pixel_format))[0],
+                                  dtype=self._output.dtype)
+        return unpack_bits(raw, pixel_bits(self.pixel_format), self._output, self._work)
+
+
+class ColorToMono:
+    """ Converts the frames of any pixel format of the camera into a single channel of integers, using preallocated
+    outputs:
+
+    * ``Mono*``: unchanged
+    * ``Bayer*``: sum of the two green pixels of every 2x2 cell, half the resolution in each direction
+    * ``RGB8``, ``BGR8``: luma, ``(77 R + 150 G + 29 B) >> 8``
+    * ``YCbCr422_8``: the Y channel
+
+    Frames are given as the camera stores them, transposed with respect to the array of the grab result, so the colour
+    channels of RGB frames are on the first axis and the bytes of YCbCr frames are interleaved along the first axis.
+    """
+    LUMA_WEIGHTS = {'RGB': (77, 150, 29), 'BGR': (29, 150, 77)}
+
+    def __init__(self, pixel_format=None):
+        self.logger = getLogger(__name__)
+        self.pixel_format = pixel_format
+        self._output = None
+        self._work = None
+
+    @property
+    def pixel_format(self):
+        return self._pixel_format
+
+    @pixel_format.setter
+    def pixel_format(self, pixel_format):
+        if pixel_format is not None and not pixel_format.startswith(('Mono', 'Bayer', 'RGB8', 'BGR8', 'YCbCr422')):
+            raise ValueError(f'Pixel format {pixel_format} can not be converted to mono')
+        self._pixel_format = pixel_format
+
+    @property
+    def active(self):
+        return self.pixel_format is not None and not self.pixel_format.startswith('Mono')
+
+    def output_shape(self, frame_shape):
+        if not self.active:
+            return tuple(frame_shape)
+        if self.pixel_format.startswith('Bayer'):
+            return frame_shape[0] // 2, frame_shape[1] // 2
+        if len(frame_shape) == 3:
+            return tuple(frame_shape[1:])
+        return (frame_shape[0] // 2, *frame_shape[1:])  # Interleaved YCbCr
+
+    def output_dtype(self, dtype):
+        if self.pixel_format is not None and self.pixel_format.startswith('Bayer'):
+            return np.dtype(np.uint16 if pixel_bits(self.pixel_format) < 16 else np.uint32)
+        if self.pixel_format is not None and self.pixel_format.startswith(('RGB', 'BGR')):
+            return np.dtype(np.uint8)
+        return np.dtype(dtype)
+
+    def _allocate(self, shape, dtype, work_dtype=None, out=None):
+        if work_dtype is not None and (self._work is None or self._work.shape[1:] != shape):
+            self._work = np.empty((2, *shape), dtype=work_dtype)
+        if out is not None:
+            return out
+        if self._output is None or self._output.shape != shape or self._output.dtype != dtype:
+            self._output = np.empty(shape, dtype=dtype)
+        return self._output
+
+    def _bayer(self, frame, out):
+        frame = frame[:frame.shape[0] // 2 * 2, :frame.shape[1] // 2 * 2]
+        if self.pixel_format[5:7] in ('RG', 'BG'):
+            green_1, green_2 = frame[0::2, 1::2], frame[1::2, 0::2]
+        else:  # GR and GB have the greens on the diagonal
+            green_1, green_2 = frame[0::2, 0::2], frame[1::2, 1::2]
+        out = self._allocate(green_1.shape, self.output_dtype(frame.dtype), out=out)
+        np.add(green_1, green_2, out=out, dtype=out.dtype)
+        return out
+
+    def _rgb(self, frame, out):
+        out = self._allocate(frame.shape[1:], self.output_dtype(frame.dtype), work_dtype=np.uint16, out=out)
+        total, channel = self._work
+        weights = self.LUMA_WEIGHTS[self.pixel_format[:3]]
+        np.multiply(frame[0], weights[0], out=total, dtype=np.uint16)
+        for i in (1, 2):
+            np.multiply(frame[i], weights[i], out=channel, dtype=np.uint16)
+            total += channel
+        np.right_shift(total, 8, out=out, casting='unsafe')
+        return out
+
+    def _ycbcr(self, frame, out):
+        luma = frame[0] if frame.ndim == 3 else frame[0::2]
+        out = self._allocate(luma.shape, luma.dtype, out=out)
+        np.copyto(out, luma)
+        return out
+
+    def process(self, frame, out=None):
+        """ Returns the mono version of a frame. Without ``out``, it is the frame itself for mono formats, otherwise
+        an output reused for the next frame. """
+        if not self.active:
+            if out is not None:
+                np.copyto(out, frame, casting='unsafe')
+                return out
+            return frame
+        if self.pixel_format.startswith('Bayer'):
+            return self._bayer(frame, out)
+        if self.pixel_format.startswith(('RGB', 'BGR')):
+            return self._rgb(frame, out)
+        return self._ycbcr(frame, out)
+
+
+class Ingest:
+    def __init__(self, binning=1, roi=None, decimation=1, pixel_format=None):
+        """ Settings of the reduction applied to every frame.
+
+        Parameters
+        ----------
+        binning : int
+            Size N of the NxN blocks of pixels that are summed into one. Rows and columns that do not fill a whole
+            block are discarded. For Bayer images, an even binning sums complete colour cells.
+        roi : tuple or None
+            ``(first_row, last_row, first_col, last_col)`` of the frame as it is stored, last values excluded. None
+            keeps the whole frame.
+        decimation : int
+            Only one frame out of every ``decimation`` is kept
+        pixel_format : str or None
+            Pixel format of the camera. Colour frames are converted to mono before anything else, see
+            :class:`ColorToMono`, so ``roi`` and ``binning`` apply to the mono frames.
+        """
+        if binning < 1 or decimation < 1:
+            raise ValueError('Binning and decimation must be at least 1')
+        self.binning = int(binning)
+        self.roi = None if roi is None else tuple(int(r) for r in roi)
+        self.decimation = int(decimation)
+        self.to_mono = ColorToMono(pixel_format)
+        self._output = None
+        self._counter = 0
+
+    @property
+    def pixel_format(self):
+        return self.to_mono.pixel_format
+
+    @pixel_format.setter
+    def pixel_format(self, pixel_format):
+        self.to_mono.pixel_format = pixel_format
+
+    @property
+    def active(self):
+        """ Whether the stage changes the frames at all. """
+        return self.binning > 1 or self.roi is not None or self.decimation > 1 or self.to_mono.active
+
+    def _crop(self, frame):
+        if self.roi is not None:
+            frame = frame[self.roi[0]:self.roi[1], self.roi[2]:self.roi[3]]
+        N = self.binning
+        return frame[:frame.shape[0] // N * N, :frame.shape[1] // N * N]
+
+    def output_shape(self, frame_shape):
+        """ Shape of the frames after the stage, for input frames of the given shape. """
+        mono_shape = self.to_mono.output_shape(frame_shape)
+        rows, cols = self._crop(np.empty(mono_shape[:2], dtype=np.uint8)).shape
+        return (rows // self.binning, cols // self.binning, *mono_shape[2:])
+
+    def output_dtype(self, dtype):
+        dtype = self.to_mono.output_dtype(dtype)
+        return binned_dtype(dtype, self.binning ** 2) if self.binning > 1 else dtype
+
+    def keep(self, frame_id=None):
+        """ Whether the frame with the given ID survives the decimation. Without ID, frames are counted as they
+        arrive.
+        """
+        if frame_id is None or frame_id < 0:
+            frame_id = self._counter
+            self._counter += 1
+        return frame_id % self.decimation == 0
+
+    def stored_id(self, frame_id):
+        """ ID of a kept frame in the decimated sequence, consecutive kept frames have consecutive IDs. """
+        return frame_id // self.decimation if frame_id >= 0 else frame_id
+
+    def process(self, frame, frame_id=None, out=None):
+        """ Reduces a single frame.
+
+        Parameters
+        ----------
+        frame : numpy.array
+            Frame with shape ``(rows, columns)`` or ``(rows, columns, channels)``
+        frame_id : int or None
+            ID of the frame given by the camera, used for the decimation so that dropped frames do not shift it
+        out : numpy.array or None
+            Where to write the reduced frame, see :meth:`~reduce`
+
+        Returns
+        -------
+        numpy.array or None
+            The reduced frame, or None if it is discarded by the decimation. Without ``out``, it may be a view on the
+            input or on an output reused for the next frame.
+        """
+        if not self.keep(frame_id):
+            return None
+        return self.reduce(frame, out)
+
+    def reduce(self, frame, out=None):
+        """ Converts, crops and bins a frame, without decimation. If ``out`` is given, for example a slot of the frame
+        buffer, the result is written directly in it. It must have the :meth:`~output_shape` and
+        :meth:`~output_dtype` of the frame.
+        """
+        if self.roi is None and self.binning == 1:
+            return self.to_mono.process(frame, out)
+        frame = self._crop(self.to_mono.process(frame))
+        N = self.binning
+        if N == 1:
+            if out is None:
+                return frame
+            np.copyto(out, frame, casting='unsafe')
+            return out
+        shape = (frame.shape[0] // N, frame.shape[1] // N, *frame.shape[2:])
+        if out is None:
+            dtype = binned_dtype(frame.dtype, N ** 2)
+            if self._output is None or self._output.shape != shape or self._output.dtype != dtype:
+                self._output = np.empty(shape, dtype=dtype)
+            out = self._output
+        blocks = frame.reshape(shape[0], N, shape[1], N, *frame.shape[2:])
+        np.sum(blocks, axis=(1, 3), dtype=out.dtype, out=out)
+        return out
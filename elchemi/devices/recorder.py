@@ -0,0 +1,192 @@
+"""
+Streaming recorder
+==================
+
+Writes the frames of a :class:`~elchemi.devices.buffer.CircularBuffer` to an HDF5 file while the acquisition is
+running. Frames are appended to a chunked, resizable dataset from a background thread, so the length of a recording is
+limited by the disk and not by the memory available.
+
+The file uses the layout that :meth:`~elchemi.experiments.harmonic_analysis.AnalyzeModel.open` reads:
+
+* ``movie/frame``: the frames, with shape ``(frames, *frame_shape)``
+* ``movie/configuration/acq_camera/frame_rate``: the frame rate of the camera, measured from the recorded frames if it
+  is not given
+* ``movie/metadata/<field>``: one value per frame, the absolute frame number in the buffer and the fields of
+  :attr:`~elchemi.devices.buffer.CircularBuffer.METADATA_DTYPE` (camera timestamp, frame ID, grab status, host
+  time and version of the camera settings)
+"""
+import time
+from logging import getLogger
+from threading import Event, Thread
+
+import h5py
+import numpy as np
+
+from elchemi.devices.buffer import metadata_frame_rate
+
+
+class Recorder:
+    COMPRESSIONS = (None, 'lzf', 'gzip')
+
+    def __init__(self, filename, buffer, frame_rate=None, configuration=None, chunks=True, compression=None,
+                 compression_opts=None, shuffle=None, poll_interval=0.05, from_start=False, tick_frequency=1e9):
+        """ Prepares the recording of the frames of a buffer, see :meth:`~start`.
+
+        Parameters
+        ----------
+        filename : str or Path
+            File to create, it is overwritten if it exists
+        buffer : CircularBuffer
+            Buffer where the camera stores the frames. The recorder reads it with its own cursor.
+        frame_rate : float or None
+            Stored in ``movie/configuration/acq_camera/frame_rate``, needed to analyze the movie later. If None, it is
+            measured from the timestamps and frame IDs of the recorded frames when the recording stops.
+        configuration : dict or None
+            Extra values stored in ``movie/configuration``, one group per key (e.g. ``acq_camera``, ``daq``)
+        chunks : tuple or True
+            Chunk shape of the frames dataset, ``(frames, *frame_shape)``. True lets h5py pick one. Chunks spanning
+            many frames of a small tile are faster to read as time traces, chunks of whole frames are faster to write.
+        compression : str or None
+            None, ``'lzf'`` (fast) or ``'gzip'`` (smaller files)
+        compression_opts : int or None
+            Level of the gzip compression, from 0 to 9
+        shuffle : bool or None
+            Byte shuffle before compressing, which helps with images of more than 8 bits. By default it is on
+            whenever there is compression.
+        poll_interval : float
+            Time in seconds the thread sleeps when there are no new frames
+        from_start : bool
+            If True, the frames already in the buffer are also recorded, otherwise only frames acquired after
+            :meth:`~start`
+        tick_frequency : float
+            Frequency of the camera clock used in the timestamps, in Hz, see
+            :attr:`~elchemi.devices.camera.basler.BaslerCamera.timestamp_frequency`
+        """
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f'Compression must be one of {self.COMPRESSIONS}, not {compression}')
+        self.logger = getLogger(__name__)
+        self.filename = filename
+        self.buffer = buffer
+        self.frame_rate = frame_rate
+        self.configuration = configuration or {}
+        self.chunks = chunks
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = compression is not None if shuffle is None else shuffle
+        self.poll_interval = poll_interval
+        self.from_start = from_start
+        self.tick_frequency = tick_frequency
+
+        self.frames_written = 0
+        self.frames_corrupted = 0  # Frames overwritten by the camera while they were written to disk
+        self._cursor = None
+        self._file = None
+        self._stop = Event()
+        self._thread = None
+
+    @property
+    def recording(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _create_file(self):
+        self._file = h5py.File(self.filename, 'w')
+        movie = self._file.create_group('movie')
+        movie.create_dataset('frame', shape=(0, *self.buffer.frame_shape), maxshape=(None, *self.buffer.frame_shape),
+                             dtype=self.buffer.dtype, chunks=self.chunks, compression=self.compression,
+                             compression_opts=self.compression_opts, shuffle=self.shuffle)
+        metadata = movie.create_group('metadata')
+        metadata.create_dataset('frame_number', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(4096,))
+        for field, (dtype, _) in self.buffer.METADATA_DTYPE.fields.items():
+            metadata.create_dataset(field, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(4096,))
+
+        configuration = dict(self.configuration)
+        camera = configuration.setdefault('acq_camera', {})
+        camera['frame_rate'] = np.nan if self.frame_rate is None else self.frame_rate
+        for group_name, values in configuration.items():
+            group = movie.create_group(f'configuration/{group_name}')
+            for key, value in values.items():
+                group[key] = value
+
+    def _append(self, dataset, values):
+        start = dataset.shape[0]
+        dataset.resize(start + len(values), axis=0)
+        dataset[start:] = values
+
+    def _write_available(self):
+        """ Writes all the frames that the cursor did not read yet. Returns the number of frames written. """
+        result = self._cursor.read_views()
+        if result is None:
+            return 0
+        first, views = result
+        N = sum(len(view) for view in views)
+        try:
+            frames_metadata = self.buffer.get_metadata(first, first + N)
+        except BufferError:
+            # The camera already lapped us, the frames are counted as corrupted below
+            frames_metadata = np.full(N, -1, dtype=self.buffer.METADATA_DTYPE)
+        movie = self._file['movie']
+        for view in views:
+            self._append(movie['frame'], view)
+        self._append(movie['metadata/frame_number'], np.arange(first, first + N))
+        for field in frames_metadata.dtype.names:
+            self._append(movie[f'metadata/{field}'], frames_metadata[field])
+        if not self.buffer.is_intact(first, first + N):
+            self.frames_corrupted += N
+            self.logger.warning(f'Frames {first} to {first + N} were overwritten while recording them')
+        self.frames_written += N
+        return N
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if self._write_available() == 0:
+                    self._stop.wait(self.poll_interval)
+            self._write_available()
+        finally:
+            movie = self._file['movie']
+            movie.attrs['lost_frames'] = self._cursor.lost_frames
+            movie.attrs['corrupted_frames'] = self.frames_corrupted
+            if self.frame_rate is None:
+                self._write_frame_rate(movie)
+            self._file.close()
+            self._file = None
+            self.buffer.remove_cursor(self._cursor.name)
+
+    def _write_frame_rate(self, movie):
+        """ Replaces the unknown frame rate of the camera by the one measured from the recorded frames. """
+        metadata = np.empty(movie['metadata/frame_id'].shape[0], dtype=self.buffer.METADATA_DTYPE)
+        for field in metadata.dtype.names:
+            metadata[field] = movie[f'metadata/{field}'][()]
+        # Frames overwritten before their metadata was read have it filled with -1
+        frame_rate = metadata_frame_rate(metadata[metadata['host_time'] >= 0], self.tick_frequency)
+        movie['configuration/acq_camera/frame_rate'][()] = frame_rate
+        self.logger.info(f'Measured frame rate of {self.filename}: {frame_rate} fps')
+
+    def start(self):
+        """ Creates the file and starts writing frames in a background thread. """
+        if self.recording:
+            raise RuntimeError(f'Already recording to {self.filename}')
+        self._cursor = self.buffer.cursor(f'recorder {id(self)}', from_start=self.from_start)
+        self._create_file()
+        self._stop.clear()
+        self.frames_written = 0
+        self.frames_corrupted = 0
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.logger.info(f'Recording {self.buffer.name} to {self.filename}')
+
+    def stop(self):
+        """ Writes the frames still pending and closes the file. """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.logger.info(f'Recorded {self.frames_written} frames to {self.filename}, '
+                         f'{self._cursor.lost_frames} lost')
+
+    def record(self, duration):
+        """ Records for the given time in seconds, blocking. """
+        self.start()
+        time.sleep(duration)
+        self.stop()
@@ -1,45 +1,114 @@
+from collections import OrderedDict
+from logging import getLogger
 from pathlib import Path
+from tempfile import TemporaryFile
+from threading import Lock, Thread
 
 import h5py
 import numpy as np
 import yaml
 from numpy.fft import fftfreq
-from scipy.fft import fft
+from scipy.fft import rfft
 from scipy.signal import spectrogram
 
-from elchemi import param_folder
+from elchemi import buffer_folder, param_folder
+from elchemi.devices.ingest import ColorToMono
+from elchemi.experiments.demodulation import LockIn, batch_fft, sliding_dft
+from elchemi.experiments.parallel import shared_empty, tiled_extract
+
+logger = getLogger(__name__)
 
 
 class AnalyzeModel:
+    ENGINE_FFT = 'fft'
+    ENGINE_SLIDING = 'sliding'
+    ENGINES = (ENGINE_FFT, ENGINE_SLIDING)
+    ENGINE_LOCKIN = 'lockin'  # Not an FFT engine, see make_lock_in
+    # Complex type of the results for each precision, see elchemi.experiments.demodulation for the tolerance
+    PRECISIONS = {
+        'double': np.complex128,
+        'single': np.complex64,
+        }
+    # Settings of the sliding window used by make_full_fft. 'gui' keeps the original behaviour of the GUI.
+    WINDOW_PRESETS = {
+        'gui': {'hop': None, 'taper': None},
+        'cycle': {'hop': 1, 'taper': None},
+        'hann': {'hop': 1, 'taper': 'hann'},
+        }
+
     metadata = {}
     data = None
+    data_file = None
     frame_rate = 0
     filename = ''
     fft_data = None
+    harmonic_data = None
+    harmonic_freqs = None
+    memory_budget = 512 * 1024**2  # Bytes that the analysis may use at once
+    workers = -1  # Cores used by scipy.fft, -1 means all
+    processes = None  # If set, the image is split in tiles processed by this many processes
+    tile_shape = None  # Shape of the tiles, see elchemi.experiments.parallel.tiled_extract
+    precision = 'double'  # One of PRECISIONS
+    roi_cache_size = 32  # Number of ROI traces and spectrograms kept in memory
+    roi_index_budget = 1024**3  # Bytes of the ROI index kept in memory, larger indices go to a file in buffer_folder
+    spectrum_cache_size = 2 * 1024**3  # Bytes of Fourier coefficients kept in memory by extract_frequencies
+    lock_in = None  # Streaming lock-in, see start_lock_in
+    lock_in_history = 1000  # Outputs of the streaming lock-in kept in fft_data
 
     def __init__(self):
         if (param_folder / '.metadata').exists():
             with open(param_folder / '.metadata') as f:
                 self.metadata = yaml.load(f, Loader=yaml.UnsafeLoader)
+        self._spectrum_cache = OrderedDict()
+        self._roi_cache = OrderedDict()
+        self._cache_lock = Lock()
+        self._cache_data = None
+        self._roi_index = None
+        self._roi_index_data = None
+        self._roi_index_thread = None
 
-    def open(self, filename):
+    def open(self, filename, lazy=True):
         """ Opens a data file. Currently, works only with Refeyn iSCAT data
         Parameters
         ----------
         filename : str or Path
             Relative or absolute position of the file to open. It will be transformed to a Path before attempting to
             open the file.
+        lazy : bool
+            If True, the file is kept open and ``data`` is the HDF5 dataset itself. Frames are read only when they are
+            needed, and the analysis reads them in pieces that fit in ``memory_budget``. If False, the whole movie is
+            loaded in memory.
         """
+        if self.data_file is not None:
+            self.data_file.close()
+            self.data_file = None
+
         self.filename = Path(filename)
-        with h5py.File(filename, 'r') as data_file:
-            self.data = data_file["movie/frame"][()]
-            self.frame_rate = data_file["movie/configuration/acq_camera"]["frame_rate"][()]
+        data_file = h5py.File(filename, 'r')
+        self.frame_rate = data_file["movie/configuration/acq_camera"]["frame_rate"][()]
+        if lazy:
+            self.data_file = data_file
+            self.data = data_file["movie/frame"]
+        else:
+            with data_file:
+                frames = data_file["movie/frame"]
+                if self.processes:
+                    # In shared memory the worker processes read the frames where they are
+                    self.data = shared_empty(frames.shape, frames.dtype)
+                    frames.read_direct(self.data)
+                else:
+                    self.data = frames[()]
 
         self.metadata.update({
             'filename': str(self.filename.name),
             'last_dir': str(self.filename.parent),
             })
 
+    def _frame_chunks(self, frame_bytes):
+        """ Splits the frames in consecutive ranges that fit in ``memory_budget``, given the bytes used per frame. """
+        step = max(1, int(self.memory_budget // frame_bytes))
+        return [(i, min(i + step, self.data.shape[0])) for i in range(0, self.data.shape[0], step)]
+
     def calculate_data_on_roi(self, X, Y):
         """ Calculates the integrated intensity over time in a given region of interest (ROI)
         Parameters
@@ -53,7 +122,71 @@ class AnalyzeModel:
         np.array
             The integrated intensity over the range of pixels for all the available frames
         """
-        return np.sum(np.sum(self.data[:, X[0]:X[1], Y[0]:Y[1]], axis=1), axis=1)
+        return self._cached(('trace', tuple(X), tuple(Y)), self._calculate_data_on_roi, X, Y)
+
+    def _calculate_data_on_roi(self, X, Y):
+        index = self._roi_index
+        if index is not None and self._roi_index_data is self.data:
+            x_0, x_1, _ = slice(X[0], X[1]).indices(self.data.shape[1])
+            y_0, y_1, _ = slice(Y[0], Y[1]).indices(self.data.shape[2])
+            x_1 = max(x_0, x_1)
+            y_1 = max(y_0, y_1)
+            # Unsigned corners may wrap around in the intermediate steps, but the final result is exact
+            added = index[:, x_1, y_1] - index[:, x_0, y_1] - index[:, x_1, y_0] + index[:, x_0, y_0]
+            return added.astype(np.sum(np.zeros(1, dtype=self.data.dtype)).dtype)
+
+        if isinstance(self.data, np.ndarray):
+            return np.sum(np.sum(self.data[:, X[0]:X[1], Y[0]:Y[1]], axis=1), axis=1)
+
+        roi_bytes = max(1, (X[1] - X[0]) * (Y[1] - Y[0]) * self.data.dtype.itemsize)
+        return np.concatenate([np.sum(self.data[first:last, X[0]:X[1], Y[0]:Y[1]], axis=(1, 2))
+                               for first, last in self._frame_chunks(roi_bytes)])
+
+    def build_roi_index(self, background=True):
+        """ Builds a summed-area table of every frame: element ``[n, i, j]`` is the sum of frame ``n`` over all the
+        pixels ``[:i, :j]``. Once it is available, :meth:`~calculate_data_on_roi` reads four corners per frame instead
+        of summing the entire ROI, which keeps moving or resizing an ROI interactive on long movies.
+
+        The table takes one integer per pixel, using 32 bits when it is enough for the largest possible sum. Until it is
+        ready, ROIs are calculated directly from the data. It is discarded when ``data`` changes. Since it is larger
+        than the movie itself, a table larger than ``roi_index_budget`` is kept in a temporary file in
+        :data:`elchemi.buffer_folder` instead of in memory, and the operating system pages in the frames being read.
+
+        Parameters
+        ----------
+        background : bool
+            If True, the table is built in a separate thread and this method returns immediately
+        """
+        data = self.data
+        if background:
+            self._roi_index_thread = Thread(target=self._build_roi_index, args=(data, ), daemon=True)
+            self._roi_index_thread.start()
+        else:
+            self._build_roi_index(data)
+
+    def _build_roi_index(self, data):
+        if np.issubdtype(data.dtype, np.integer):
+            max_sum = int(np.iinfo(data.dtype).max) * int(np.prod(data.shape[1:]))
+            dtype = np.uint32 if max_sum < 2**32 and np.iinfo(data.dtype).min == 0 else np.int64
+        else:
+            dtype = np.float64
+        shape = (data.shape[0], data.shape[1] + 1, data.shape[2] + 1)
+        index_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if index_bytes > self.roi_index_budget:
+            logger.warning(f'The ROI index takes {index_bytes / 1024**3:.1f} GiB, more than the roi_index_budget of '
+                           f'{self.roi_index_budget / 1024**3:.1f} GiB, it is stored on disk in {buffer_folder}')
+            buffer_folder.mkdir(exist_ok=True)
+            # The file is deleted as soon as the index is released
+            index = np.memmap(TemporaryFile(dir=buffer_folder), dtype=dtype, mode='w+', shape=shape)
+        else:
+            index = np.zeros(shape, dtype=dtype)
+        frame_bytes = int(np.prod(data.shape[1:])) * np.dtype(dtype).itemsize
+        for first, last in self._frame_chunks(frame_bytes):
+            chunk = np.cumsum(data[first:last], axis=1, dtype=dtype)
+            np.cumsum(chunk, axis=2, dtype=dtype, out=index[first:last, 1:, 1:])
+        logger.debug(f'ROI index ready for {data.shape[0]} frames')
+        self._roi_index_data = data
+        self._roi_index = index
 
     def calculate_fft_on_roi(self, X, Y):
         """ Calculates the Fourier transform over a range of pixels. It first integrates the intensity in the ROI and
@@ -77,12 +210,10 @@ class AnalyzeModel:
         max_power : float
             The maximum power at the given maximum frequency, without considering 0Hz
 
-        .. Todo:: check if rfft is better option, could be 2x faster.
+        The data is real, so only the positive half of the spectrum is calculated.
         """
-
-
-        added = self.calculate_data_on_roi(X, Y)
-        transformed = fft(added)
+        added = self.calculate_data_on_roi(X, Y).astype(self._real_dtype)
+        transformed = rfft(added)
         N = len(added)
         freqs = fftfreq(N, 1 / self.frame_rate)[:N // 2]
         power = 2.0 / N * np.abs(transformed[0:N // 2])
@@ -92,11 +223,15 @@ class AnalyzeModel:
 
         return freqs, power, max_freq, max_power
 
-    def calculate_spectrogram_on_roi(self, X, Y, overlap=128):
+    def calculate_spectrogram_on_roi(self, X, Y, overlap=128, nperseg=256):
         """ Calculates the spectrogram on a given region of interest. It uses a base overlap of 128 data points,
         meaning that the sliding window used for the spectrogram will have some concatenation. Depending on the
         modulation frequency, the overlap can be changed to improve the resolution or to lower the computational effort
 
+        Spectrograms are cached per ROI, ``nperseg`` and ``overlap``, so going back to a previous ROI or overlap is
+        immediate. The integrated intensity is cached per ROI as well, and it is shared with
+        :meth:`~calculate_data_on_roi` and :meth:`~calculate_fft_on_roi`.
+
         Parameters
         ----------
         X : tuple or list
@@ -105,6 +240,8 @@ class AnalyzeModel:
             Y-range for the ROI
         overlap : int
             Number of frames that will overlap while calculating the spetrogram
+        nperseg : int
+            Number of frames in each segment. It must be larger than ``overlap``
 
         Returns
         -------
@@ -114,46 +251,92 @@ class AnalyzeModel:
             The times at which the FFT was calculated
         Sxx : numpy.array
             The spectrogram itself. This is the direct result of using `scipy.signal.spectrogram`
+
+        Raises
+        ------
+        ValueError
+            If ``overlap`` is not smaller than ``nperseg``
         """
-        added = self.calculate_data_on_roi(X, Y)
-        f, t, Sxx = spectrogram(added, fs=self.frame_rate, axis=0, mode='complex', noverlap=overlap)
-        return f, t, Sxx
+        if not 0 <= overlap < nperseg:
+            raise ValueError(f'The overlap must be between 0 and {nperseg - 1} frames, not {overlap}')
+        key = ('spectrogram', tuple(X), tuple(Y), nperseg, overlap, self.precision)
+        return self._cached(key, self._calculate_spectrogram_on_roi, X, Y, overlap, nperseg)
+
+    def _calculate_spectrogram_on_roi(self, X, Y, overlap, nperseg):
+        added = self.calculate_data_on_roi(X, Y).astype(self._real_dtype)
+        return spectrogram(added, fs=self.frame_rate, axis=0, mode='complex', nperseg=nperseg, noverlap=overlap)
+
+    def _cached(self, key, method, *args):
+        """ Returns the result of calling method with the given arguments, or the stored one if it was already
+        calculated for the same key. Only the latest ``roi_cache_size`` results are kept. """
+        with self._cache_lock:
+            self._validate_cache()
+            if key in self._roi_cache:
+                self._roi_cache.move_to_end(key)
+                return self._roi_cache[key]
+        # The lock is not held while calculating, ROIs are requested from the GUI and from worker threads
+        result = method(*args)
+        with self._cache_lock:
+            self._roi_cache[key] = result
+            while len(self._roi_cache) > self.roi_cache_size:
+                self._roi_cache.popitem(last=False)
+        return result
 
-    def make_full_fft(self, freq, min_cycles, frame_rate, pixel_format = None):
+    def make_full_fft(self, freq, min_cycles, frame_rate, pixel_format = None, engine=ENGINE_FFT, harmonics=1, hop=None,
+                      taper=None, window=None):
         """ Calculates the FFT on the entire image stack. It splits the data into "cycles" which is the number of
-        frames that it takes for a full oscillation, based on the external driving frequency. It grabs a minimum
-        number of oscillations before calculating the FFT, and it makes a sliding window that jumps one cycle at a
-        time.
+        frames that it takes for a full oscillation, based on the external driving frequency. Each FFT is calculated
+        on a window of ``min_cycles`` oscillations, and the window slides ``hop`` cycles at a time.
+
+        The fundamental ends up in ``fft_data``, while ``harmonic_data`` holds the fundamental and the higher harmonics
+        with their frequencies in ``harmonic_freqs``. Results are cached, see :meth:`~extract_frequencies`.
 
         Parameters
         ----------
         freq : float
             Frequency (in Hertz) to calculate the number of frames and to extract from the FFT
         min_cycles : int
-            Number of cycles to use to calculate the FFT
+            Number of cycles to use to calculate the FFT, this is the length of the window
+        engine : str
+            Either ``'fft'``, which transforms the windows in batches and keeps the bin closest to ``freq`` (see
+            :func:`~elchemi.experiments.demodulation.batch_fft`), or ``'sliding'``,
+            which updates that single bin recursively from one window to the next (see
+            :func:`~elchemi.experiments.demodulation.sliding_dft`). Both give the same ``fft_data``.
+        harmonics : int
+            Number of harmonics to extract, 1 means only the fundamental
+        hop : float or None
+            Number of cycles between the start of consecutive windows. With ``hop=N`` there are N times fewer windows
+            than with ``hop=1``. If None, windows start on consecutive frames and there are as many as cycles in the
+            data, which is the ``'gui'`` entry of ``WINDOW_PRESETS``.
+        taper : str or None
+            Taper applied to each window before the transform, for example ``'hann'``. See the engines for the
+            supported values.
+        window : int or None
+            Number of frames of each window, ``min_cycles`` cycles of ``freq`` by default. With a fixed window, the
+            windows, and therefore the cached spectra, do not depend on ``freq``: changing the frequency or the number
+            of harmonics only picks other bins, see :meth:`~extract_frequencies`. ``min_cycles`` is then the number of
+            cycles in the window, used for ``hop``.
 
-        .. todo::
-            The FFT calculates all the frequencies, but only one is key. Perhaps this should be extended to avoid
-            recalculating when the user wants to explore other frequencies.
-        .. todo::
-            The code forces a sliding window that jumps one cycle each time. It may be wise of give flexibility to
-            select the window.
+        Raises
+        ------
+        ValueError
+            If the data is shorter than a single window
         """
-        print(f'Data: {self.data}\n\n\n')
-        print(f'Type: {np.shape(self.data)}\n\n\n')
-        print(f'FRAME RATE: {self.frame_rate}')
-
-        if pixel_format == 'BayerRG8':
-            self.data = np.squeeze(self.data, axis = 1)
-            green_ch1 = self.data[:,0::2, 0::2]
-            green_ch2 = self.data[:,1::2, 1::2]
-            self.data = (green_ch1.astype(np.float32) + green_ch2.astype(np.float32))/2.0
-            print(f'\n\n self data : {self.data}')
+        logger.debug(f'Data shape: {np.shape(self.data)}, frame rate: {self.frame_rate}')
+
+        self._to_mono(pixel_format)
         if frame_rate:
             self.frame_rate = frame_rate
 
-        min_frames = int(self.frame_rate / freq)  # How many frames to record a full oscillation
-        cycle_frames = min_frames * min_cycles  # How many frames there are in the total integration period
+        if window is None:
+            min_frames = int(self.frame_rate / freq)  # How many frames to record a full oscillation
+            cycle_frames = min_frames * min_cycles  # How many frames there are in the total integration period
+        else:
+            min_frames = max(1, window // min_cycles)
+            cycle_frames = window
+        if cycle_frames < 1 or self.data.shape[0] < cycle_frames:
+            raise ValueError(f'A window of {min_cycles} cycles at {freq} Hz needs {cycle_frames} frames at '
+                             f'{self.frame_rate} fps, but there are only {self.data.shape[0]}')
 
         self.metadata.update({
             'freq': min_frames,
@@ -161,18 +344,297 @@ class AnalyzeModel:
             })
 
         self.freqs = fftfreq(cycle_frames, 1 / self.frame_rate)  # [:cycle_frames // 2]
-        close_freq = (np.abs(self.freqs - freq)).argmin()
 
-        num_calculations = int(self.data.shape[0] / min_frames)  # jump a cycle to speed up FFT calculation
+        if hop is None:
+            hop_frames = 1
+            num_calculations = int(self.data.shape[0] / min_frames)
+            # Windows must be complete, otherwise the bin would belong to a shorter FFT
+            num_calculations = min(num_calculations, self.data.shape[0] - cycle_frames + 1)
+        else:
+            hop_frames = max(1, int(round(hop * min_frames)))
+            num_calculations = (self.data.shape[0] - cycle_frames) // hop_frames + 1
+
+        self.metadata.update({
+            'hop': hop_frames,
+            'taper': taper,
+            })
+
+        self.harmonic_freqs = [n * freq for n in range(1, harmonics + 1)]
+        self.harmonic_data = self.extract_frequencies(self.harmonic_freqs, cycle_frames, num_calculations, engine,
+                                                      hop=hop_frames, taper=taper)
+        self.fft_data = self.harmonic_data[0]
+
+    def make_lock_in(self, freq, min_cycles, frame_rate=None, pixel_format=None, phase=0., filter=LockIn.FILTER_IIR,
+                     order=2, output_every=None, times=None):
+        """ Demodulates the entire stack with a digital lock-in referenced to the modulation applied by the DAQ, see
+        :class:`~elchemi.experiments.demodulation.LockIn`. Contrary to :meth:`~make_full_fft`, the frequency is used
+        exactly, without rounding it to an FFT bin. Frames are processed in chunks that fit in ``memory_budget``, so
+        lazy data is never loaded at once.
+
+        The result is stored in ``fft_data``, so it can be displayed like the FFT.
+
+        Parameters
+        ----------
+        freq : float
+            Modulation frequency in Hertz
+        min_cycles : int
+            Length of the low-pass filter in cycles of the modulation. It is the time constant of each IIR stage, or
+            the length of the boxcar
+        frame_rate : float or None
+            If given, it replaces the frame rate of the data
+        phase : float
+            Phase of the modulation (in radians) at the first frame, or at time 0 if ``times`` are given
+        filter : str
+            One of ``LockIn.FILTERS``
+        order : int
+            Number of stages of the IIR filter
+        output_every : int or None
+            Number of frames between outputs. By default there is one output per cycle of the modulation
+        times : numpy.array or None
+            Time of each frame in seconds since the start of the modulation. By default frames are assumed to be
+            evenly spaced at the frame rate.
+        """
+        self._to_mono(pixel_format)
+        if frame_rate:
+            self.frame_rate = frame_rate
+
+        lock_in = self._new_lock_in(freq, min_cycles, phase, filter, order)
+        output_every = output_every or max(1, int(self.frame_rate / freq))
+
+        frame_bytes = int(np.prod(self.data.shape[1:])) * lock_in.dtype.itemsize * (order + 2)
+        self.fft_data = np.concatenate([lock_in.process(self.data[first:last], output_every=output_every,
+                                                        times=None if times is None else times[first:last])
+                                        for first, last in self._frame_chunks(frame_bytes)])
+        self._set_lock_in_results(freq)
+
+    def start_lock_in(self, freq, min_cycles, frame_rate, phase=0., filter=LockIn.FILTER_IIR, order=2,
+                      output_every=None):
+        """ Prepares a lock-in that demodulates a stream of frames as it arrives, fed by :meth:`~feed_lock_in`.
+        Contrary to :meth:`~make_lock_in`, the state of the filters is kept between chunks, so every frame is
+        processed only once. The parameters are the same as for :meth:`~make_lock_in`.
+        """
+        self.frame_rate = frame_rate
+        self.lock_in = self._new_lock_in(freq, min_cycles, phase, filter, order)
+        self._lock_in_every = output_every or max(1, int(frame_rate / freq))
+        self.fft_data = None
+        self.harmonic_data = None
+
+    def feed_lock_in(self, frames, times=None, pixel_format=None):
+        """ Demodulates the next frames of the stream with the lock-in made by :meth:`~start_lock_in`. The new
+        outputs are appended to ``fft_data``, which keeps the last ``lock_in_history`` of them. The frames become
+        ``data``.
+
+        Parameters
+        ----------
+        frames : numpy.array
+            Next frames of the stream, time is the first dimension
+        times : numpy.array or None
+            Time of each frame in seconds since the start of the modulation, see
+            :meth:`~elchemi.experiments.demodulation.LockIn.process`
+        pixel_format : str or None
+            Pixel format of the frames, color frames are converted to a single channel
+
+        Returns
+        -------
+        numpy.array
+            The new outputs, it can be empty
+        """
+        self.data = frames
+        self._to_mono(pixel_format)
+        outputs = self.lock_in.process(self.data, output_every=self._lock_in_every, times=times)
+        if len(outputs):
+            history = outputs if self.fft_data is None else np.concatenate([self.fft_data, outputs])
+            self.fft_data = history[-self.lock_in_history:]
+            self._set_lock_in_results(self.lock_in.frequency)
+        return outputs
+
+    def _new_lock_in(self, freq, min_cycles, phase, filter, order):
+        return LockIn(freq, self.frame_rate, phase=phase, time_constant=min_cycles / freq, filter=filter,
+                      order=order, boxcar_frames=int(round(min_cycles * self.frame_rate / freq)),
+                      dtype=self.PRECISIONS[self.precision])
+
+    def _set_lock_in_results(self, freq):
+        self.freqs = np.array([freq])
+        self.harmonic_freqs = [freq]
+        self.harmonic_data = self.fft_data[np.newaxis]
+
+    def _to_mono(self, pixel_format):
+        """ Converts color data into a single channel with :class:`~elchemi.devices.ingest.ColorToMono`, the same
+        conversion the ingest stage applies to live frames. For Bayer formats, it sums the two green pixels of each
+        cell.
+        """
+        to_mono = ColorToMono(pixel_format)
+        if not to_mono.active:
+            return
+        if self.data.ndim == 4:
+            self.data = np.squeeze(self.data, axis=1)
+        mono = np.empty((self.data.shape[0], *to_mono.output_shape(self.data.shape[1:])),
+                        dtype=to_mono.output_dtype(self.data.dtype))
+        for frame, out in zip(self.data, mono):
+            to_mono.process(frame, out=out)
+        self.data = mono
+
+    def extract_frequencies(self, frequencies, window, num_windows, engine=ENGINE_FFT, hop=1, taper=None):
+        """ Extracts the Fourier coefficients of several frequencies on sliding windows over the entire stack, in a
+        single pass over the data. Every frequency is rounded to the closest bin of a ``window``-points FFT.
+
+        Coefficients are cached per bin, window, hop, taper, number of windows and precision for as long as ``data`` is
+        the same object. Asking again for the same frequencies returns the cached array itself, without copying it, so
+        it must not be modified. Only the bins that are not cached yet are calculated. The least recently used results
+        are discarded once the cache takes more than ``spectrum_cache_size`` bytes. If ``data`` is modified in place,
+        :meth:`~clear_cache` must be called.
+
+        If ``processes`` is set, the image is split in tiles that are processed in parallel, see
+        :func:`~elchemi.experiments.parallel.tiled_extract`.
+
+        Parameters
+        ----------
+        frequencies : list of float
+            Frequencies (in Hertz) to extract
+        window : int
+            Number of frames on which each FFT is calculated
+        num_windows : int
+            Number of windows to calculate
+        engine : str
+            One of ``ENGINES``, see :meth:`~make_full_fft`
+        hop : int
+            Number of frames between the start of consecutive windows
+        taper : str or None
+            Taper applied to each window
+
+        Returns
+        -------
+        numpy.array
+            Complex array of shape ``(len(frequencies), num_windows, *data.shape[1:])``
+        """
+        if engine not in self.ENGINES:
+            raise ValueError(f'Engine must be one of {self.ENGINES} and not {engine}')
+        self._validate_cache()
+
+        freqs = fftfreq(window, 1 / self.frame_rate)
+        bins = tuple(int((np.abs(freqs - f)).argmin()) for f in frequencies)
+        key = (window, hop, taper, num_windows, self.precision)
+        if key + (bins, ) in self._spectrum_cache:
+            self._spectrum_cache.move_to_end(key + (bins, ))
+            return self._spectrum_cache[key + (bins, )]
+
+        # Bins already calculated for other combinations of frequencies are views on the cached arrays
+        cached = {}
+        for entry_key, entry in self._spectrum_cache.items():
+            if entry_key[:-1] == key:
+                cached.update({b: coefficient for b, coefficient in zip(entry_key[-1], entry)})
+        missing = sorted({b for b in bins if b not in cached})
+
+        if missing:
+            logger.debug(f'Calculating bins {missing} on {num_windows} windows of {window} frames every {hop} frames')
+            coefficients = self._calculate_bins(missing, window, num_windows, engine, hop, taper)
+            if list(bins) == missing:
+                result = coefficients
+            else:
+                cached.update(zip(missing, coefficients))
+        if not missing or list(bins) != missing:
+            first = cached[bins[0]]
+            result = np.empty((len(bins), *first.shape), dtype=first.dtype)
+            for i, b in enumerate(bins):
+                result[i] = cached[b]
+        self._cache_spectrum(key, bins, result)
+        return result
+
+    def _cache_spectrum(self, key, bins, result):
+        """ Stores the result of :meth:`~extract_frequencies`, replacing the entries whose bins it contains, and
+        discards the least recently used entries while the cache takes more than ``spectrum_cache_size`` bytes. """
+        for entry_key in list(self._spectrum_cache):
+            if entry_key[:-1] == key and set(entry_key[-1]) <= set(bins):
+                del self._spectrum_cache[entry_key]
+        if result.nbytes > self.spectrum_cache_size:
+            return
+        self._spectrum_cache[key + (bins, )] = result
+        while sum(entry.nbytes for entry in self._spectrum_cache.values()) > self.spectrum_cache_size:
+            self._spectrum_cache.popitem(last=False)
+
+    def _calculate_bins(self, bins, window, num_windows, engine, hop, taper):
+        """ Runs the engine on the whole data, reading lazy data in pieces that fit in ``memory_budget``.
+
+        Lazy data is read in blocks of consecutive frames, each holding as many complete windows as fit in half of the
+        budget. Consecutive blocks overlap by ``window - hop`` frames. If a window of whole frames does not fit, the
+        frames are also split in strips of rows, as many as the HDF5 chunks hold, so that every chunk is read (and
+        decompressed) about once and not once per strip. If even that does not fit, for example with chunks of whole
+        frames, the budget is exceeded rather than reading the frames many times.
+
+        With ``processes``, the blocks are read into a single array in shared memory and the results are written in
+        shared memory too, so the worker processes use both without copying them.
+        """
+        if isinstance(self.data, np.ndarray):
+            return self._run_engine(self.data, bins, window, num_windows, engine, hop, taper)
+        shape = (len(bins), num_windows, *self.data.shape[1:])
+        if self.processes:
+            coefficients = shared_empty(shape, self.PRECISIONS[self.precision])
+        else:
+            coefficients = np.empty(shape, dtype=self.PRECISIONS[self.precision])
+        height = self.data.shape[1]
+        row_bytes = int(np.prod(self.data.shape[2:])) * self.data.dtype.itemsize  # One row of one frame
+        chunk_rows = self.data.chunks[1] if self.data.chunks is not None else 1
+        rows = int(self.memory_budget // (2 * window * row_bytes)) // chunk_rows * chunk_rows
+        rows = min(height, max(chunk_rows, rows))
+        frames = int(self.memory_budget // (2 * rows * row_bytes))
+        if frames < window:
+            # Blocks of a single window would read every frame window / hop times, two windows read them at most twice
+            frames = 2 * window
+            logger.warning(f'Windows of {window} frames of {rows} rows do not fit in the memory budget, it is exceeded '
+                           f'to read blocks of {frames} frames. Consider a larger memory_budget or HDF5 chunks of '
+                           f'fewer rows.')
+        windows_per_block = min(num_windows, (frames - window) // hop + 1)
+        block_frames = (windows_per_block - 1) * hop + window
+        block_buffer = None
+        if self.processes:
+            block_buffer = shared_empty((block_frames, rows, *self.data.shape[2:]), self.data.dtype)
+
+        for first_row in range(0, height, rows):
+            last_row = min(height, first_row + rows)
+            for start in range(0, num_windows, windows_per_block):
+                count = min(windows_per_block, num_windows - start)
+                source = np.s_[start * hop:start * hop + (count - 1) * hop + window, first_row:last_row]
+                if block_buffer is None:
+                    block = self.data[source]
+                else:
+                    destination = np.s_[:(count - 1) * hop + window, :last_row - first_row]
+                    self.data.read_direct(block_buffer, source_sel=source, dest_sel=destination)
+                    block = block_buffer[destination]
+                self._run_engine(block, bins, window, count, engine, hop, taper,
+                                 out=coefficients[:, start:start + count, first_row:last_row])
+        return coefficients
+
+    def _run_engine(self, data, bins, window, num_windows, engine, hop, taper, out=None):
+        """ Runs the selected engine on an array that is already in memory, writing the result in ``out`` if given.
+        """
+        dtype = self.PRECISIONS[self.precision]
+        if self.processes:
+            kwargs = {'hop': hop, 'taper': taper, 'dtype': dtype}
+            if engine == self.ENGINE_FFT:
+                kwargs['memory_budget'] = self.memory_budget
+            return tiled_extract(data, bins, window, num_windows, engine=engine, processes=self.processes,
+                                 tile_shape=self.tile_shape, out=out, **kwargs)
+        if engine == self.ENGINE_SLIDING:
+            return sliding_dft(data, bins, window, num_windows, hop=hop, taper=taper, dtype=dtype, out=out)
+        return batch_fft(data, bins, window, num_windows, hop=hop, taper=taper, memory_budget=self.memory_budget,
+                         workers=self.workers, dtype=dtype, out=out)
+
+    @property
+    def _real_dtype(self):
+        return np.finfo(self.PRECISIONS[self.precision]).dtype
 
-        print(f'\n\n\n\n \t self.data.shape[0] {num_calculations} and self.data.shape[2] {self.data.shape[2]}')
-        self.fft_data = np.zeros((num_calculations, self.data.shape[1], self.data.shape[2]),
-                                 dtype=complex)
+    def _validate_cache(self):
+        """ Cached results are only valid for the data they were calculated on. """
+        if self._cache_data is not self.data:
+            self.clear_cache()
+            self._cache_data = self.data
 
-        for i in range(num_calculations):
-            print(f'{100 * i / num_calculations:.4} %\r')
-            to_analyze = self.data[i:i + cycle_frames, :, :]
-            self.fft_data[i, :, :] = fft(to_analyze, axis=0)[close_freq]
+    def clear_cache(self):
+        """ Forgets all the coefficients calculated by :meth:`~extract_frequencies` and the ROI traces and
+        spectrograms. """
+        self._spectrum_cache = OrderedDict()
+        self._roi_cache = OrderedDict()
+        self._cache_data = None
 
     def close(self):
         """ Cleans up the memory used by the data and the fft data.
@@ -182,7 +644,14 @@ class AnalyzeModel:
             a memory leak by creating hanging arrays without a reference.
         """
         self.data = None
+        if self.data_file is not None:
+            self.data_file.close()
+            self.data_file = None
         self.fft_data = None
+        self.harmonic_data = None
+        self.clear_cache()
+        self._roi_index = None
+        self._roi_index_data = None
 
     def __del__(self):
         with open(param_folder / '.metadata', 'w') as f:
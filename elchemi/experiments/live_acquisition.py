@@ -5,7 +5,10 @@ import time
 import numpy as np
 from queue import Queue
 from scipy.fft import rfft
-# from elchemi.devices.DAQ.waveforms import DwfController as dwfc
+
+from elchemi.devices.camera.array import CameraArray
+from elchemi.devices.camera.basler import BaslerCamera
+from elchemi.devices.camera.simulated import ModulatedScene, SimulatedBaslerCamera
 
 
 class LiveAcquisition:
@@ -18,6 +21,7 @@ class LiveAcquisition:
         self.config_file = config_file
         self.config = {}
         self.camera = None
+        self.cameras = None  # CameraArray of all the cameras, see connect_devices
         self.daq = None
 
 
@@ -26,16 +30,32 @@ class LiveAcquisition:
             self.config = yaml.load(f, Loader=yaml.FullLoader)
 
     def connect_devices(self):
-
+        """ Connects the DAQ and the cameras of the configuration, grouped in a
+        :class:`~elchemi.devices.camera.array.CameraArray` triggered by the DAQ, so that their frames are numbered by
+        trigger. A single camera is an array of one. Simulated cameras pace their frames themselves and need no DAQ.
+        """
         # this method should be connected to a separate button on the live_acquisition GUI window to connect devices.
         # this allows the GUI to be also useful for pure display of saved date, even without connection to devices
-        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-        self.camera.Open()
-        # Display a list of devices and their possible configurations
-        devs = dwfc.enumerate_devices()
-        dwfc.print_device_list(devs)
-        # Create object for device number 0, with config number 0
-        self.daq = dwfc(0, 0)
+        config_camera = self.config['camera']
+        names = config_camera.get('array') or [config_camera['name']]
+        buffer_size = config_camera.get('buffer_size', 1000)
+        if config_camera.get('simulated', False):
+            simulation = dict(self.config.get('simulation', {}))
+            frame_rate = simulation.pop('frame_rate', 1000.)
+            cameras = [SimulatedBaslerCamera(name, buffer_size, scene=ModulatedScene(**simulation),
+                                             frame_rate=frame_rate) for name in names]
+            self.daq = None
+        else:
+            # Only imported with real devices, it needs the library of the DAQ
+            from elchemi.devices.DAQ.waveforms import DwfController
+            cameras = [BaslerCamera(name, buffer_size) for name in names]
+            self.daq = DwfController(0, 0)
+        for camera in cameras:
+            camera.shared_buffer = config_camera.get('shared_buffer', False)
+            camera.buffer_on_disk = config_camera.get('buffer_on_disk', False)
+        self.cameras = CameraArray(cameras, daq=self.daq, trigger_source=config_camera.get('trigger_source', 'Line1'),
+                                   trigger_pin=self.config['daq'].get('trigger_pin', 0))
+        self.cameras.initialize()
 
 
     def daq_signal_on(self):
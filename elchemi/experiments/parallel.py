@@ -0,0 +1,254 @@
+"""
+Tiled execution
+===============
+
+Runs the demodulation engines on spatial tiles of an image stack, using a pool of processes. Every pixel is
+independent from the others, so the image can be split into tiles that are processed in parallel without any
+communication between them.
+
+The workers attach to the stack and to the output instead of receiving them, so no frames are pickled. Arrays created
+with :func:`~shared_empty`, views on them, and memory mapped files (``numpy.memmap``) are used where they are; any other
+input is copied once to shared memory. The workers write their results directly into the output.
+
+The pool of processes is started the first time it is needed and reused by the following calls, since starting the
+processes takes longer than analyzing a small block. :func:`~shutdown_pool` stops it, it also happens when Python exits.
+"""
+import atexit
+import mmap
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from threading import Lock
+
+import numpy as np
+
+from elchemi.experiments.demodulation import batch_fft, sliding_dft
+
+ENGINES = {
+    'fft': batch_fft,
+    'sliding': sliding_dft,
+    }
+
+_shared = {}  # Shared memory created by shared_empty, by name: (SharedMemory, first address, size)
+_pool = None
+_pool_processes = None
+_pool_lock = Lock()
+
+
+def _release(name):
+    """ Destroys the shared memory of an array made by :func:`~shared_empty` once the array and its views are gone. """
+    shm, _, _ = _shared.pop(name)
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        # The array is being deleted and still holds the mapping, it is released right after this.
+        # Forget it here, otherwise SharedMemory tries to close it again when deleted.
+        shm._mmap = None
+
+
+def shared_empty(shape, dtype):
+    """ Creates an uninitialized array in shared memory, that the workers of :func:`~tiled_extract` use without
+    copying it, both as input and as output. The shared memory is destroyed when the array and all its views are
+    garbage collected.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the array
+    dtype : numpy.dtype
+        Type of the array
+
+    Returns
+    -------
+    numpy.array
+    """
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _shared[shm.name] = (shm, array.ctypes.data, size)
+    weakref.finalize(array, _release, shm.name)
+    return array
+
+
+def _spec(array):
+    """ Everything a worker needs to attach to an array in shared memory or in a memory mapped file, or None if the
+    array is in neither. It can be pickled.
+    """
+    address = array.__array_interface__['data'][0]
+    strides = array.strides
+    if isinstance(array, np.memmap) and array.filename is not None and array._mmap is not None:
+        # numpy maps the file from the multiple of the allocation granularity right before its offset
+        mapped = np.frombuffer(array._mmap, dtype=np.uint8).__array_interface__['data'][0]
+        position = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY + address - mapped
+        return 'file', array.filename, position, array.shape, strides, array.dtype.str
+    for name, (_, first, size) in list(_shared.items()):
+        if first <= address < first + size:
+            return 'shm', name, address - first, array.shape, strides, array.dtype.str
+    return None
+
+
+def _attach(spec, writable):
+    """ Runs in the worker processes. Returns the shared memory or the mapped file to release when done, and the
+    array.
+    """
+    kind, name, offset, shape, strides, dtype = spec
+    if kind == 'shm':
+        shm = shared_memory.SharedMemory(name=name)
+        return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset, strides=strides)
+    mapped = np.memmap(name, dtype=np.uint8, mode='r+' if writable else 'r')
+    return mapped, np.ndarray(shape, dtype=dtype, buffer=mapped, offset=offset, strides=strides)
+
+
+def _process_tile(input_spec, output_spec, rows, cols, engine, bins, window, num_windows, kwargs):
+    """ Runs in the worker processes. It attaches to the input and the output, and processes a single tile. """
+    in_handle, data = _attach(input_spec, writable=False)
+    out_handle, out = _attach(output_spec, writable=True)
+    try:
+        ENGINES[engine](data[:, rows[0]:rows[1], cols[0]:cols[1]], bins, window, num_windows,
+                        out=out[:, :, rows[0]:rows[1], cols[0]:cols[1]], **kwargs)
+    finally:
+        # The arrays export the shared buffers, they must be gone before closing
+        del data, out
+        if isinstance(out_handle, np.memmap):
+            out_handle.flush()
+        for handle in (in_handle, out_handle):
+            if isinstance(handle, shared_memory.SharedMemory):
+                handle.close()
+
+
+def get_pool(processes=None):
+    """ Returns the pool of worker processes, starting it if it is not running or has a different number of
+    processes.
+
+    Parameters
+    ----------
+    processes : int or None
+        Number of worker processes, by default one per core
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+    """
+    global _pool, _pool_processes
+    processes = processes or os.cpu_count()
+    with _pool_lock:
+        if _pool is None or _pool_processes != processes:
+            if _pool is not None:
+                _pool.shutdown()
+            _pool = ProcessPoolExecutor(max_workers=processes)
+            _pool_processes = processes
+        return _pool
+
+
+def shutdown_pool():
+    """ Stops the worker processes. The next call to :func:`~tiled_extract` starts them again. """
+    global _pool, _pool_processes
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = _pool_processes = None
+
+
+atexit.register(shutdown_pool)
+
+
+def make_tiles(shape, tile_shape):
+    """ Splits an image of the given shape into tiles.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image, (rows, columns)
+    tile_shape : tuple
+        Maximum shape of each tile, (rows, columns). Tiles on the borders may be smaller.
+
+    Returns
+    -------
+    list
+        A list of ``((first_row, last_row), (first_col, last_col))``, last values are excluded
+    """
+    return [((r, min(r + tile_shape[0], shape[0])), (c, min(c + tile_shape[1], shape[1])))
+            for r in range(0, shape[0], tile_shape[0])
+            for c in range(0, shape[1], tile_shape[1])]
+
+
+def tiled_extract(data, bins, window, num_windows, engine='fft', processes=None, tile_shape=None, out=None,
+                  **kwargs):
+    """ Extracts FFT bins like the engines in :mod:`~elchemi.experiments.demodulation`, but splitting the image in
+    tiles that are processed in a pool of processes.
+
+    Parameters
+    ----------
+    data : numpy.array
+        Stack of frames with shape (frames, rows, columns). If it was made by :func:`~shared_empty` (or is a view on
+        such an array) or is a ``numpy.memmap``, the workers read it in place, otherwise it is copied to shared memory.
+    bins : list of int
+        Indices of the bins to extract
+    window : int
+        Number of frames in each window
+    num_windows : int
+        Number of windows to calculate
+    engine : str
+        One of the keys of ``ENGINES``
+    processes : int or None
+        Number of worker processes, by default one per core
+    tile_shape : tuple or None
+        Shape (rows, columns) of the tiles. By default the image is split in strips of full rows, four per process,
+        so that every tile reads contiguous lines of each frame.
+    out : numpy.array or None
+        Array of shape ``(len(bins), num_windows, rows, columns)`` where the workers write the result. It should be
+        shareable like ``data``, otherwise the result goes through a temporary array in shared memory. By default a
+        new array is made with :func:`~shared_empty`.
+    kwargs
+        Passed to the engine, for example ``hop``, ``taper`` or ``dtype``. If the engine uses ``memory_budget``, it
+        is divided between the processes.
+
+    Returns
+    -------
+    numpy.array
+        ``out``, or a new array of the ``dtype`` given to the engine
+    """
+    out_dtype = np.dtype(kwargs.get('dtype', np.complex128))
+    processes = processes or os.cpu_count()
+    if tile_shape is None:
+        tile_shape = (max(1, -(-data.shape[1] // (4 * processes))), data.shape[2])
+    if engine == 'fft':
+        # Processes are already using all the cores
+        kwargs['workers'] = 1
+        if 'memory_budget' in kwargs:
+            kwargs['memory_budget'] = kwargs['memory_budget'] // processes
+
+    out_shape = (len(bins), num_windows, *data.shape[1:])
+    if out is None:
+        out = shared_empty(out_shape, out_dtype)
+    elif out.shape != out_shape:
+        raise ValueError(f'out has shape {out.shape}, the result has shape {out_shape}')
+    input_spec = _spec(data)
+    if input_spec is None:
+        shared = shared_empty(data.shape, data.dtype)
+        shared[:] = data
+        input_spec = _spec(shared)
+    output_spec = _spec(out)
+    result = out
+    if output_spec is None:
+        result = shared_empty(out_shape, out.dtype)
+        output_spec = _spec(result)
+
+    executor = get_pool(processes)
+    futures = [executor.submit(_process_tile, input_spec, output_spec, rows, cols, engine, list(bins), window,
+                               num_windows, kwargs)
+               for rows, cols in make_tiles(data.shape[1:], tile_shape)]
+    try:
+        for future in futures:
+            future.result()  # Re-raises exceptions from the workers
+    except BrokenProcessPool:
+        # A worker died, the pool can't be used anymore
+        shutdown_pool()
+        raise
+    if result is not out:
+        out[:] = result
+    return out
@@ -1,11 +1,12 @@
+from logging import getLogger
 from pathlib import Path
 
 import numpy as np
 import pyqtgraph as pg
 from PyQt5 import uic
 from PyQt5.QtCore import Qt, QTimer
-from PyQt5.QtWidgets import QFileDialog, QMainWindow, QScrollBar
-from threading import Thread, Event
+from PyQt5.QtWidgets import QFileDialog, QMainWindow, QScrollBar, QSpinBox
+from threading import Thread
 
 from elchemi.experiments.harmonic_analysis import AnalyzeModel
 from elchemi.experiments.live_acquisition import LiveAcquisition
@@ -13,9 +14,11 @@ from elchemi.view import VIEW_FOLDER
 from elchemi.view.config_widget import ConfigWidget
 from elchemi.view.roi_plots import RoiWindow
 from elchemi.devices.camera.basler import BaslerCamera
-from elchemi.devices.buffer import Buffer
+from elchemi.devices.camera.simulated import ModulatedScene, SimulatedBaslerCamera
+from elchemi.devices.ingest import Ingest
 
 home_path = Path.home()
+logger = getLogger(__name__)
 
 
 class DisplayWindow(QMainWindow):
@@ -74,11 +77,19 @@ class DisplayWindow(QMainWindow):
         self.fft_phase_widget.setPredefinedGradient('cyclic')
         self.fft_selector = QScrollBar(Qt.Vertical)
         self.fft_selector.valueChanged.connect(self.update_fft)
+        self.harmonic_selector = QSpinBox()
+        self.harmonic_selector.setPrefix('Harmonic ')
+        self.harmonic_selector.setRange(1, 16)
+        self.harmonic_selector.valueChanged.connect(self.update_harmonic)
         self.fft_images_window = fft_images_window
         self.fft_refresh_rate = fft_refresh_rate
         self.fft_thread = None
+        self.fft_window = None  # Frames of the FFT windows, kept when only the frequency changes, see calculate_fft
+        self.fft_cycles = None
+        self._lock_in_settings = None  # Settings of the lock-in of the live data, see calculate_lock_in
 
         layout = self.fft_widget.layout()
+        layout.addWidget(self.harmonic_selector)
         layout.addWidget(self.fft_selector)
         layout.addWidget(self.fft_image_widget)
         layout.addWidget(self.fft_phase_widget)
@@ -114,6 +125,17 @@ class DisplayWindow(QMainWindow):
         self.line_totalframes.setText(str(config_data['total_frames']))
 
     def connect_balser(self):
+        config_camera = self.live_model.config['camera']
+        if config_camera.get('simulated', False):
+            simulation = dict(self.live_model.config.get('simulation', {}))
+            frame_rate = simulation.pop('frame_rate', 1000.)
+            self.basler = SimulatedBaslerCamera(external_buffer_size=self.basler.external_buffer_size,
+                                                scene=ModulatedScene(**simulation), frame_rate=frame_rate)
+        self.basler.shared_buffer = config_camera.get('shared_buffer', False)
+        self.basler.buffer_on_disk = config_camera.get('buffer_on_disk', False)
+        self.basler.external_buffer_size = config_camera.get('buffer_size', self.basler.external_buffer_size)
+        self.basler.ingest = Ingest(binning=config_camera.get('binning', 1), roi=config_camera.get('analysis_roi'),
+                                    decimation=config_camera.get('decimation', 1))
         self.basler.initialize()
         self.basler.set_acquisition_mode(self.basler.MODE_LAST)
 
@@ -134,6 +156,9 @@ class DisplayWindow(QMainWindow):
         self.timer.start(self.refresh_rate)
 
         self.basler.start_continuous_reads()
+        # Frame timestamps in host time are what keeps the lock-in referenced to the modulation
+        self.basler.latch_clock()
+        self.analyze_model.lock_in = None
 
 
     def disconnect_basler(self):
@@ -149,8 +174,9 @@ class DisplayWindow(QMainWindow):
 
     def update_raw_data(self):
         '''Method to update the image displayed in the raw data window. It could be merged with update_image in the future.'''
-        if hasattr(self.basler, 'temp_image'):
-            self.image_widget.setImage(self.basler.temp_image)
+        image = self.basler.temp_image
+        if image is not None:
+            self.image_widget.setImage(image)
         else:
             self.basler.logger.info('Tried to fetch image when none were available.')
 
@@ -191,6 +217,8 @@ class DisplayWindow(QMainWindow):
             return
 
         self.analyze_model.open(str(file))
+        if self.live_model.config['data'].get('roi_index', False):
+            self.analyze_model.build_roi_index(background=True)
         self.filename_name.setText(str(file.stem))
         self.image_widget.setImage(self.analyze_model.data[0, :, :], autoLevels=True)
 
@@ -204,10 +232,24 @@ class DisplayWindow(QMainWindow):
         self.image_widget.setImage(self.analyze_model.data[frame_no, :, :], autoLevels=False, autoRange=False)
 
     def update_fft(self, frame_no):
-        self.fft_image_widget.setImage(np.abs(self.analyze_model.fft_data[frame_no, :, :]), autoLevels=False,
-                                       autoRange=False)
-        self.fft_phase_widget.setImage(np.angle(self.analyze_model.fft_data[frame_no, :, :]), autoLevels=False,
-                                       autoRange=False)
+        harmonic = self.displayed_harmonic()
+        self.fft_image_widget.setImage(np.abs(harmonic[frame_no, :, :]), autoLevels=False, autoRange=False)
+        self.fft_phase_widget.setImage(np.angle(harmonic[frame_no, :, :]), autoLevels=False, autoRange=False)
+
+    def displayed_harmonic(self):
+        """ Amplitudes of the harmonic chosen with the harmonic selector, or of the highest one calculated. """
+        harmonic_data = self.analyze_model.harmonic_data
+        return harmonic_data[min(self.harmonic_selector.value(), len(harmonic_data)) - 1]
+
+    def update_harmonic(self, harmonic):
+        if self.analyze_model.harmonic_data is None:
+            return
+        if harmonic <= len(self.analyze_model.harmonic_data):
+            self.update_fft(self.fft_selector.value())
+        elif hasattr(self, 'loaded_data'):
+            # Only the bins of the new harmonics are calculated, the others are in the cache. Live data picks the
+            # harmonic up on the next refresh.
+            self.calculate_fft(frame_rate=None)
 
     def add_roi(self):
         if self.roi is not None:
@@ -234,31 +276,78 @@ class DisplayWindow(QMainWindow):
             self.fft_timer.start(self.fft_refresh_rate)
 
     def update_fft_data(self):
-        img_list = []
-        self.basler.external_buffer.pause_storage.set()
-        while not self.basler.external_buffer.get_buffer().empty():
-            img_list.append(self.basler.external_buffer.get_buffer().get())
-        img_list.reverse()
-        self.analyze_model.data = np.array(img_list)
-        self.analyze_model.frame_rate = np.mean(np.array(self.basler.external_buffer.frame_rates))
-        self.basler.external_buffer.pause_storage.clear()
-        print(f'Average Camera Frame Rate: {self.analyze_model.frame_rate} \nStandard Deviation Frame Rate: {np.array(np.std(self.basler.external_buffer.frame_rates))}')
-
-        if self.fft_thread is None or not self.fft_thread.is_alive():
-            self._stop_fft = Event()
-            self.fft_thread = Thread(target=self.calculate_fft, args=[np.mean(np.array(self.basler.external_buffer.frame_rates))])
+        """ Takes a snapshot of the frames in the buffer and analyzes it on a separate thread. If the previous
+        analysis is still running, this refresh is skipped and the next one takes all the frames stored meanwhile.
+        """
+        buffer = self.basler.external_buffer
+        if buffer is None or len(buffer) == 0:
+            return
+        if self.fft_thread is not None and self.fft_thread.is_alive():
+            return
+        if self.live_model.config['data'].get('engine') == AnalyzeModel.ENGINE_LOCKIN:
+            # The lock-in keeps its state between refreshes, it only needs the frames stored since the last one
+            result = buffer.cursor('lockin', from_start=True).copy()
+            if result is None:
+                return
+            _, frames, metadata = result
+            self.fft_thread = Thread(target=self.calculate_lock_in, args=[frames, self.basler.frame_times(metadata)])
             self.fft_thread.start()
+            return
+        # Starts at the oldest frame, so that the first refresh analyzes the frames already in the buffer
+        cursor = buffer.cursor('fft', from_start=True)
+        if cursor.available == 0:
+            return  # No new frames since the last calculation
+        # The camera keeps writing in the buffer, the analysis works on a snapshot of the frames available now. The
+        # oldest frames may be overwritten while they are copied, those are left out of the snapshot.
+        self.analyze_model.data = cursor.copy_last(len(buffer))
+        self.analyze_model.frame_rate = self.basler.measured_frame_rate(len(self.analyze_model.data))
+        logger.info(f'Average camera frame rate: {self.analyze_model.frame_rate}, '
+                    f'dropped frames: {buffer.dropped_frames}')
+
+        self.fft_thread = Thread(target=self.calculate_fft, args=[self.analyze_model.frame_rate])
+        self.fft_thread.start()
+
+    def modulation_reference(self):
+        """ ``(start time, frequency, phase)`` of the modulation applied by the DAQ, or of the scene filmed by the
+        simulated camera. None if it is not known.
+        """
+        daq = getattr(self.live_model, 'daq', None)
+        if daq is not None and daq.modulation_reference is not None:
+            return daq.modulation_reference
+        if isinstance(self.basler, SimulatedBaslerCamera):
+            return self.basler.scene.modulation_reference
+        return None
+
+    def calculate_lock_in(self, frames, frame_times):
+        """ Feeds the frames stored since the last refresh to the lock-in of the live data, starting a new lock-in if
+        the settings changed. The reference is built from the time of each frame and the start of the modulation, so
+        its phase doesn't depend on which frames each refresh gets. Without a known modulation, the frequency box and
+        the phase in the configuration are used, counting from the first frame.
+        """
+        cycles = int(self.min_cycles_line.text())
+        reference = self.modulation_reference()
+        if reference is None:
+            freq = float(self.frequency_line.text())
+            phase = self.live_model.config['daq'].get('phase', 0.)
+            start = times = None
         else:
-            self.fft_timer.stop()
-            self._stop_fft.wait()
-            self.fft_timer.start(self.fft_refresh_rate)
-            self._stop_fft.clear()        
-        
-        # Here we have a thread starter and runner 
-
-        # Thread need to wait for previous
+            start, freq, phase = reference
+            times = frame_times - start
+
+        settings = (freq, cycles, phase, start)
+        if self.analyze_model.lock_in is None or settings != self._lock_in_settings:
+            self.analyze_model.precision = self.live_model.config['data'].get('precision', 'double')
+            self.analyze_model.start_lock_in(freq, cycles, self.basler.measured_frame_rate(), phase=phase)
+            self._lock_in_settings = settings
+        pixel_format = self.basler.get_pixelformat() if self.basler.ingest is None else None
+        if not len(self.analyze_model.feed_lock_in(frames, times=times, pixel_format=pixel_format)):
+            return
 
-        # Then make_full_fft in live analysis will handle the different types of images and data
+        self.fft_selector.setMinimum(0)
+        self.fft_selector.setMaximum(self.analyze_model.fft_data.shape[0] - 1)
+        harmonic = self.displayed_harmonic()
+        self.fft_image_widget.setImage(np.abs(harmonic[-1, :, :]))
+        self.fft_phase_widget.setImage(np.angle(harmonic[-1, :, :]))
 
     def change_pixel_format(self):
         self.basler.set_pixelformat(self.pixel_format_box.currentText())
@@ -267,19 +356,40 @@ class DisplayWindow(QMainWindow):
         freq = float(self.frequency_line.text())
         cycles = int(self.min_cycles_line.text())
 
-        self.analyze_model.make_full_fft(freq, cycles, frame_rate = frame_rate, pixel_format= self.basler.get_pixelformat())
+        engine = self.live_model.config['data'].get('engine', AnalyzeModel.ENGINE_FFT)
+        harmonics = max(int(self.live_model.config['data'].get('harmonics', 1)), self.harmonic_selector.value())
+        window_settings = dict(AnalyzeModel.WINDOW_PRESETS[self.live_model.config['data'].get('preset', 'gui')])
+        self.analyze_model.precision = self.live_model.config['data'].get('precision', 'double')
+
+        # The ingest stage already converted the frames to mono on the way into the buffer
+        pixel_format = self.basler.get_pixelformat() if self.basler.ingest is None else None
+        if engine == AnalyzeModel.ENGINE_LOCKIN:
+            self.analyze_model.make_lock_in(freq, cycles, frame_rate=frame_rate, pixel_format=pixel_format,
+                                            phase=self.live_model.config['daq'].get('phase', 0.))
+        else:
+            # The window only changes with the number of cycles, or if it became too short for the frequency, so that
+            # going back and forth between frequencies reuses the spectra already calculated
+            frames_per_cycle = int((frame_rate or self.analyze_model.frame_rate) / freq)
+            if self.fft_window is None or cycles != self.fft_cycles or self.fft_window < frames_per_cycle * cycles:
+                self.fft_window = frames_per_cycle * cycles
+                self.fft_cycles = cycles
+            try:
+                self.analyze_model.make_full_fft(freq, cycles, frame_rate=frame_rate, pixel_format=pixel_format,
+                                                 engine=engine, harmonics=harmonics, window=self.fft_window,
+                                                 **window_settings)
+            except ValueError as e:
+                # Not enough frames yet for a single window, e.g. right after starting or with a short buffer
+                logger.warning(f'Skipping the FFT: {e}')
+                return
 
         self.fft_selector.setMinimum(0)
         self.fft_selector.setMaximum(self.analyze_model.fft_data.shape[0] - 1)
 
         self.close_freq = (np.abs(self.analyze_model.freqs - freq)).argmin()
 
-        self.fft_image_widget.setImage(np.abs(self.analyze_model.fft_data[0, :, :]))
-        self.fft_phase_widget.setImage(np.angle(self.analyze_model.fft_data[0, :, :]))
-        if hasattr(self, 'loaded_data'):
-            self._stop_read.set()
-            self.fft_thread.join()
-            del self.fft_thread
+        harmonic = self.displayed_harmonic()
+        self.fft_image_widget.setImage(np.abs(harmonic[0, :, :]))
+        self.fft_phase_widget.setImage(np.angle(harmonic[0, :, :]))
 
 
     def close_data(self):
@@ -1,49 +1,123 @@
+from logging import getLogger
 from pathlib import Path
+from threading import Thread
 
 import numpy as np
+import pyqtgraph as pg
+import pyqtgraph.exporters
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
 from PyQt5 import uic
+from PyQt5.QtCore import QRectF, pyqtSignal
+from PyQt5.QtGui import QIntValidator
 from PyQt5.QtWidgets import QFileDialog, QMainWindow
 
 from elchemi.experiments.harmonic_analysis import AnalyzeModel
 from elchemi.view import VIEW_FOLDER
 
 home_path = Path.home()
+logger = getLogger(__name__)
 
 class RoiWindow(QMainWindow):
-    def __init__(self, model:AnalyzeModel=None, title=''):
+    calculated = pyqtSignal(object)
+    nperseg = 256  # Frames in each segment of the spectrogram, the overlap must be smaller
+
+    def __init__(self, model:AnalyzeModel=None, title='', overlap=128):
         """
         :param measurement model: Model used to analyze the data
+
+        The analysis of the ROI runs on a separate thread, and the plots are updated once it finishes. The spectrogram
+        is displayed as an image, which is much faster to render than a mesh.
         """
         super().__init__(parent=None)
         uic.loadUi(str(VIEW_FOLDER / 'GUI' / 'roi_data.ui'), self)
         self.analysis_model = model
         self.setWindowTitle(title)
+        self.X = None
+        self.Y = None
+        self.overlap = overlap
 
         self.plot = MplCanvas(parent=self)
         self.plot_widget.layout().addWidget(self.plot)
 
-        self.spectrogram = MplCanvas(parent=self)
+        self.spectrogram = pg.PlotWidget()
+        self.spectrogram.setLabel('bottom', 'Time', units='s')
+        self.spectrogram.setLabel('left', 'Frequency', units='Hz')
+        self.spectrogram_image = pg.ImageItem()
+        self.spectrogram.addItem(self.spectrogram_image)
         self.spectrogram_widget.layout().addWidget(self.spectrogram)
 
         self.fft = MplCanvas(parent=self)
         self.fft_widget.layout().addWidget(self.fft)
 
+        self.overlap_line.setText(str(self.overlap))
+        # Values that are not accepted never emit editingFinished
+        self.overlap_line.setValidator(QIntValidator(0, self.nperseg - 1, self))
+        self.overlap_line.editingFinished.connect(self.update_overlap)
+        self.calculated.connect(self.update_plots)
         self.action_save_plots.triggered.connect(self.save_plots)
 
     def set_roi(self, X, Y):
+        self.X = X
+        self.Y = Y
+        self.calculate()
+
+    def update_overlap(self):
+        """ Takes the overlap typed by the user. It must be smaller than the segments of the spectrogram, which are
+        shorter than ``nperseg`` if the movie has fewer frames. Other values are rejected and the current overlap is
+        displayed again.
+        """
+        try:
+            overlap = int(self.overlap_line.text())
+        except ValueError as e:
+            logger.warning(f'Invalid overlap for the spectrogram: {e}')
+            self.overlap_line.setText(str(self.overlap))
+            return
+        nperseg = self.segment_length()
+        if not 0 <= overlap < nperseg:
+            logger.warning(f'The overlap must be between 0 and {nperseg - 1} frames, not {overlap}')
+            self.overlap_line.setText(str(self.overlap))
+            return
+        if overlap != self.overlap:
+            self.overlap = overlap
+            self.calculate()
+
+    def segment_length(self):
+        """ Frames in each segment of the spectrogram, ``nperseg`` unless the movie is shorter. """
+        data = self.analysis_model.data if self.analysis_model is not None else None
+        if data is None:
+            return self.nperseg
+        return max(1, min(self.nperseg, data.shape[0]))
+
+    def calculate(self):
+        """ Starts the analysis of the current ROI on a separate thread. Results are displayed by
+        :meth:`~update_plots` when they are ready. """
+        Thread(target=self._calculate, args=(self.X, self.Y, self.overlap), daemon=True).start()
+
+    def _calculate(self, X, Y, overlap):
         data = self.analysis_model.calculate_data_on_roi(X, Y)
         freqs, power, max_freq, max_power = self.analysis_model.calculate_fft_on_roi(X, Y)
-        f, t, Sxx = self.analysis_model.calculate_spectrogram_on_roi(X, Y)
+        nperseg = self.segment_length()
+        f, t, Sxx = self.analysis_model.calculate_spectrogram_on_roi(X, Y, overlap=min(overlap, nperseg - 1),
+                                                                     nperseg=nperseg)
+        self.calculated.emit((X, Y, overlap, data, freqs, power, max_freq, max_power, f, t, Sxx))
+
+    def update_plots(self, results):
+        X, Y, overlap, data, freqs, power, max_freq, max_power, f, t, Sxx = results
+        if (X, Y, overlap) != (self.X, self.Y, self.overlap):
+            return  # The ROI or the overlap changed while calculating, a newer result is on its way
         x = np.linspace(0, len(data)/self.analysis_model.frame_rate, len(data))
 
+        self.plot.axes.clear()
         self.plot.axes.plot(x, data)
         self.plot.axes.set_xlabel('Time (s)')
         self.plot.axes.set_ylabel('Integrated intensity')
-        self.spectrogram.axes.pcolormesh(t, f, np.abs(Sxx), shading='gouraud')
-        self.spectrogram.axes.set_xlabel('Time (s)')
-        self.spectrogram.axes.set_ylabel('Frequency (Hz)')
+        self.plot.draw_idle()
+
+        self.spectrogram_image.setImage(np.abs(Sxx).T, autoLevels=True)
+        self.spectrogram_image.setRect(QRectF(t[0], f[0], t[-1] - t[0], f[-1] - f[0]))
+
+        self.fft.axes.clear()
         self.fft.axes.plot(freqs, power)
         self.fft.axes.plot(max_freq, max_power, 'o')
         self.fft.axes.grid()
@@ -51,6 +125,7 @@ class RoiWindow(QMainWindow):
         self.fft.axes.set_xscale('log')
         self.fft.axes.set_xlabel('Frequency (Hz)')
         self.fft.axes.set_ylabel('Power')
+        self.fft.draw_idle()
 
         self.max_freq_line.setText(f'{max_freq:.3f} Hz')
 
@@ -65,7 +140,7 @@ class RoiWindow(QMainWindow):
         save_dir.mkdir(exist_ok=True)
 
         self.fft.figure.savefig(save_dir/'fft.png')
-        self.spectrogram.figure.savefig(save_dir/'spectrogram.png')
+        pg.exporters.ImageExporter(self.spectrogram.plotItem).export(str(save_dir/'spectrogram.png'))
         self.plot.figure.savefig(save_dir/'plot.png')
 
 class MplCanvas(FigureCanvasQTAgg):